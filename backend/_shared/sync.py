@@ -0,0 +1,58 @@
+'''
+Копирует общие модули из backend/_shared в каталоги функций.
+Каждая функция деплоится из своего каталога, поэтому модуль должен лежать рядом с index.py.
+
+Запуск:
+    python backend/_shared/sync.py          # обновить копии
+    python backend/_shared/sync.py --check  # только проверить, что копии не разошлись с оригиналом
+'''
+import argparse
+import os
+import sys
+from typing import List
+
+SHARED_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(SHARED_DIR)
+FUNCTIONS = ['anime', 'auth', 'chat', 'file-upload', 'ratings']
+# Модуль -> функции, которым он нужен
+SHARED_MODULES = {
+    'db_pool.py': FUNCTIONS,
+    'triggers.py': ['chat', 'ratings'],
+}
+HEADER = '# Копия backend/_shared/{name}, не редактировать: правьте оригинал и запустите python backend/_shared/sync.py\n'
+
+def render(name: str) -> str:
+    with open(os.path.join(SHARED_DIR, name), encoding='utf-8') as f:
+        return HEADER.format(name=name) + f.read()
+
+def sync(check: bool) -> List[str]:
+    stale: List[str] = []
+    for name, functions in SHARED_MODULES.items():
+        expected = render(name)
+        for function in functions:
+            path = os.path.join(BACKEND_DIR, function, name)
+            current = None
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    current = f.read()
+            if current == expected:
+                continue
+            stale.append(os.path.relpath(path, os.path.dirname(BACKEND_DIR)))
+            if not check:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(expected)
+    return stale
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Sync shared backend modules into function directories')
+    parser.add_argument('--check', action='store_true', help='fail if any copy differs from the original')
+    args = parser.parse_args()
+    
+    stale = sync(args.check)
+    for path in stale:
+        print(('out of date: ' if args.check else 'updated: ') + path)
+    if args.check and stale:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -7,12 +7,79 @@ Returns: HTTP ответ dict
 
 import json
 import os
+import io
+import csv
+import base64
+import gzip
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+import brotli
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from db_pool import get_db_connection, release_db_connection
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 import jwt
 
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+DEFAULT_SEARCH_LIMIT = int(os.environ.get('SEARCH_DEFAULT_LIMIT', '20'))
+
+CATALOG_CACHE_TTL_SECONDS = int(os.environ.get('CATALOG_CACHE_TTL', '60'))
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', '128'))
+CATALOG_VERSION_CHECK_SECONDS = int(os.environ.get('CATALOG_VERSION_CHECK_SECONDS', '5'))
+
+# Кэш сериализованных ответов каталога живет между вызовами теплого контейнера
+_catalog_cache: 'OrderedDict[Tuple, Tuple[float, str, str, str]]' = OrderedDict()
+_catalog_version: Dict[str, Any] = {'value': None, 'checked_at': 0.0}
+_catalog_lock = threading.Lock()
+
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+# Сжатые варианты ответов по ETag (хэш тела), чтобы не сжимать один и тот же каталог на каждом попадании в кэш
+_compressed_bodies: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+
+BULK_IMPORT_MAX_ROWS = int(os.environ.get('BULK_IMPORT_MAX_ROWS', '10000'))
+# Ограничения колонок anime: VARCHAR(255), VARCHAR(50), DECIMAL(3,1), INTEGER
+ANIME_TITLE_MAX_LENGTH = 255
+ANIME_STATUS_MAX_LENGTH = 50
+ANIME_RATING_MAX = 99.9
+PG_INTEGER_MAX = 2147483647
+
+ANIME_INSERT_COLUMNS = [
+    'title', 'image_url', 'episodes', 'rating', 'description', 'genres',
+    'release_year', 'status', 'video_quality_4k', 'video_quality_1080p',
+    'video_quality_720p', 'video_quality_480p', 'anime_type',
+    'duration_minutes', 'is_movie', 'created_at', 'updated_at'
+]
+
+# Поля карточки каталога и колонки anime, из которых они строятся
+CARD_FIELD_COLUMNS = {
+    'id': 'id',
+    'title': 'title',
+    'image': 'image_url',
+    'episodes': 'episodes',
+    'rating': 'rating',
+    'description': 'description',
+    'genres': 'genres',
+    'releaseYear': 'release_year',
+    'status': 'status',
+    'isMovie': 'is_movie',
+    'duration': 'duration_minutes'
+}
+
+ADMIN_COLUMNS = [
+    'id', 'title', 'image_url', 'episodes', 'rating', 'description', 'genres',
+    'release_year', 'status', 'created_at', 'updated_at', 'video_quality_4k',
+    'video_quality_1080p', 'video_quality_720p', 'video_quality_480p', 'anime_type',
+    'duration_minutes', 'is_movie', 'cover_file_id', 'video_file_id'
+]
+
+
 def verify_admin_token(event: Dict) -> Dict[str, Any]:
     token = event.get('headers', {}).get('x-auth-token', '')
     if not token:
@@ -29,13 +96,516 @@ def verify_admin_token(event: Dict) -> Dict[str, Any]:
     except jwt.InvalidTokenError:
         return {'error': 'Invalid token'}
 
+def encode_cursor(release_year: Optional[int], anime_id: int) -> str:
+    raw = f"{release_year or 0}:{anime_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Optional[Tuple[int, int]]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        year, anime_id = base64.urlsafe_b64decode(padded.encode()).decode().split(':')
+        return int(year), int(anime_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def parse_page_size(value: Optional[str], default: int = DEFAULT_PAGE_SIZE) -> int:
+    try:
+        size = int(value) if value else default
+    except ValueError:
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def build_list_query(columns: List[str], anime_type: str,
+                     after: Optional[Tuple[int, int]], limit: Optional[int]) -> Tuple[str, List[Any]]:
+    # Ключ сортировки (release_year, id) стабилен и обслуживается индексом idx_anime_catalog_order
+    conditions = []
+    params: List[Any] = []
+    
+    if anime_type == 'movies':
+        conditions.append('is_movie = TRUE')
+    elif anime_type == 'series':
+        conditions.append('is_movie = FALSE')
+    
+    if after:
+        conditions.append('(COALESCE(release_year, 0), id) < (%s, %s)')
+        params.extend(after)
+    
+    query = f"SELECT {', '.join(columns)} FROM anime"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    
+    if limit is None:
+        query += ' ORDER BY release_year DESC, id DESC'
+    else:
+        query += ' ORDER BY COALESCE(release_year, 0) DESC, id DESC LIMIT %s'
+        params.append(limit + 1)
+    
+    return query, params
+
+def build_search_query(columns: List[str], anime_type: str, search: str, limit: int,
+                       genre_filter: Optional[Dict[str, List[str]]] = None) -> Tuple[str, Dict[str, Any]]:
+    # Операторы pg_trgm (%, <%) и ILIKE обслуживаются GIN-индексами по title и description,
+    # похожесть триграмм дает устойчивость к опечаткам и служит оценкой релевантности
+    conditions = [
+        '(title %% %(q)s OR %(q)s <%% title OR title ILIKE %(pattern)s OR %(q)s <%% description)'
+    ]
+    if anime_type == 'movies':
+        conditions.append('is_movie = TRUE')
+    elif anime_type == 'series':
+        conditions.append('is_movie = FALSE')
+    
+    genre_filter = genre_filter or {}
+    if genre_filter.get('all'):
+        conditions.append('genres @> %(genres_all)s::text[]')
+    if genre_filter.get('any'):
+        conditions.append('genres && %(genres_any)s::text[]')
+    
+    query = f'''
+        SELECT {', '.join(columns)},
+               GREATEST(
+                   similarity(title, %(q)s),
+                   word_similarity(%(q)s, title),
+                   word_similarity(%(q)s, COALESCE(description, '')) * 0.5
+               ) + CASE WHEN title ILIKE %(pattern)s THEN 1 ELSE 0 END AS relevance
+        FROM anime
+        WHERE {' AND '.join(conditions)}
+        ORDER BY relevance DESC, id DESC
+        LIMIT %(limit)s
+    '''
+    return query, {
+        'q': search,
+        'pattern': f'%{search}%',
+        'limit': limit,
+        'genres_all': genre_filter.get('all'),
+        'genres_any': genre_filter.get('any')
+    }
+
+def build_snapshot_filters(anime_type: str, genre_filter: Dict[str, List[str]]) -> Tuple[List[str], List[Any]]:
+    conditions = []
+    params: List[Any] = []
+    
+    if anime_type == 'movies':
+        conditions.append('is_movie = TRUE')
+    elif anime_type == 'series':
+        conditions.append('is_movie = FALSE')
+    
+    # @> и && по genres обслуживаются GIN-индексом
+    if genre_filter.get('all'):
+        conditions.append('genres @> %s::text[]')
+        params.append(genre_filter['all'])
+    if genre_filter.get('any'):
+        conditions.append('genres && %s::text[]')
+        params.append(genre_filter['any'])
+    
+    return conditions, params
+
+def build_snapshot_query(anime_type: str, after: Optional[Tuple[int, int]],
+                         limit: Optional[int], fields: Optional[List[str]] = None,
+                         genre_filter: Optional[Dict[str, List[str]]] = None) -> Tuple[str, List[Any]]:
+    params: List[Any] = []
+    
+    # Проекция вырезает лишние ключи из готовой карточки на стороне БД
+    item = 'item'
+    if fields:
+        item = '(item - %s::text[])'
+        params.append([field for field in CARD_FIELD_COLUMNS if field not in fields])
+    
+    conditions, filter_params = build_snapshot_filters(anime_type, genre_filter or {})
+    params.extend(filter_params)
+    
+    if after:
+        conditions.append('(sort_year, anime_id) < (%s, %s)')
+        params.extend(after)
+    
+    where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    
+    if limit is None:
+        query = f"""
+            SELECT COALESCE(string_agg({item}::text, ', ' ORDER BY sort_year DESC, anime_id DESC), '') AS items
+            FROM anime_catalog_items{where}
+        """
+    else:
+        query = f"""
+            SELECT {item}::text AS item, sort_year AS release_year, anime_id AS id
+            FROM anime_catalog_items{where}
+            ORDER BY sort_year DESC, anime_id DESC
+            LIMIT %s
+        """
+        params.append(limit + 1)
+    
+    return query, params
+
+def parse_genre_filter(query_params: Dict[str, Any]) -> Dict[str, List[str]]:
+    def split_genres(value: Optional[str]) -> List[str]:
+        return sorted({genre.strip() for genre in (value or '').split(',') if genre.strip()})
+    
+    genres_all = split_genres(query_params.get('genres_all'))
+    if query_params.get('genre', '').strip():
+        genres_all = sorted(set(genres_all) | {query_params['genre'].strip()})
+    return {'all': genres_all, 'any': split_genres(query_params.get('genres_any'))}
+
+def get_catalog_facets(cur, anime_type: str, genre_filter: Dict[str, List[str]]) -> str:
+    # Счетчики пересчитываются только после смены версии каталога, до этого берутся из кэша
+    key = ('facets', anime_type, tuple(genre_filter['all']), tuple(genre_filter['any']))
+    cached = catalog_cache_get(key)
+    if cached is not None:
+        return cached[0]
+    
+    conditions, params = build_snapshot_filters(anime_type, genre_filter)
+    where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    cur.execute(f'''
+        WITH filtered AS (
+            SELECT genres, sort_year, status FROM anime_catalog_items{where}
+        )
+        SELECT 'genres' AS facet, genre AS value, COUNT(*) AS total
+        FROM filtered, unnest(genres) AS genre
+        GROUP BY genre
+        UNION ALL
+        SELECT 'years', sort_year::text, COUNT(*) FROM filtered WHERE sort_year > 0 GROUP BY sort_year
+        UNION ALL
+        SELECT 'statuses', COALESCE(status, ''), COUNT(*) FROM filtered GROUP BY status
+        ORDER BY facet, total DESC, value
+    ''', params)
+    
+    facets: Dict[str, Dict[str, int]] = {'genres': {}, 'years': {}, 'statuses': {}}
+    for row in cur.fetchall():
+        facets[row['facet']][row['value']] = row['total']
+    
+    facets_json = json.dumps(facets)
+    catalog_cache_put(key, facets_json)
+    return facets_json
+
+def render_catalog_body(items_json: str, extra_json: Dict[str, str]) -> str:
+    # Значения extra_json уже сериализованы, тело собирается без повторного json.dumps карточек
+    body = '{"anime": [' + items_json + ']'
+    for key, value in extra_json.items():
+        body += f', {json.dumps(key)}: {value}'
+    return body + '}'
+
+def refresh_catalog_items(cur, anime_ids: List[Any]) -> None:
+    # Пересобирает предсериализованные карточки только для измененных строк
+    cur.execute('''
+        INSERT INTO anime_catalog_items (anime_id, is_movie, sort_year, genres, status, item, updated_at)
+        SELECT a.id, COALESCE(a.is_movie, FALSE), COALESCE(a.release_year, 0),
+               COALESCE(a.genres, ARRAY[]::text[]), a.status,
+               jsonb_build_object(
+                   'id', a.id::text,
+                   'title', a.title,
+                   'image', a.image_url,
+                   'episodes', a.episodes,
+                   'rating', COALESCE(a.rating, 0)::float8,
+                   'description', a.description,
+                   'genres', COALESCE(to_jsonb(a.genres), '[]'::jsonb),
+                   'releaseYear', a.release_year,
+                   'status', a.status,
+                   'isMovie', COALESCE(a.is_movie, FALSE),
+                   'duration', a.duration_minutes
+               ),
+               CURRENT_TIMESTAMP
+        FROM anime a
+        WHERE a.id = ANY(%s::int[])
+        ON CONFLICT (anime_id) DO UPDATE SET
+            is_movie = EXCLUDED.is_movie,
+            sort_year = EXCLUDED.sort_year,
+            genres = EXCLUDED.genres,
+            status = EXCLUDED.status,
+            item = EXCLUDED.item,
+            updated_at = EXCLUDED.updated_at
+    ''', ([str(anime_id) for anime_id in anime_ids],))
+
+def parse_fields(value: Optional[str], allowed: List[str]) -> Tuple[Optional[List[str]], Optional[str]]:
+    if not value:
+        return None, None
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = sorted(requested - set(allowed))
+    if unknown:
+        return None, f"Неизвестные поля: {', '.join(unknown)}"
+    return [field for field in allowed if field in requested], None
+
+def serialize_anime(anime_dict: Dict[str, Any], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    card = {
+        'id': str(anime_dict['id']),
+        'title': anime_dict.get('title'),
+        'image': anime_dict.get('image_url'),
+        'episodes': anime_dict.get('episodes'),
+        'rating': float(anime_dict['rating']) if anime_dict.get('rating') else 0.0,
+        'description': anime_dict.get('description'),
+        'genres': anime_dict['genres'] if anime_dict.get('genres') else [],
+        'releaseYear': anime_dict.get('release_year'),
+        'status': anime_dict.get('status'),
+        'isMovie': anime_dict.get('is_movie', False),
+        'duration': anime_dict.get('duration_minutes')
+    }
+    if fields:
+        return {field: card[field] for field in fields}
+    return card
+
+def split_page(rows: List[Dict[str, Any]], limit: Optional[int]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last['release_year'], last['id'])
+
+def catalog_cache_key(query_params: Dict[str, Any]) -> Optional[Tuple]:
+    if query_params.get('action') == 'get_all' or query_params.get('search', '').strip():
+        return None
+    cursor = query_params.get('cursor') or ''
+    limit = parse_page_size(query_params.get('limit')) if cursor or 'limit' in query_params else None
+    fields, fields_error = parse_fields(query_params.get('fields'), list(CARD_FIELD_COLUMNS))
+    if fields_error or (cursor and not decode_cursor(cursor)):
+        # Некорректный запрос не кэшируется и не получает 304 по ETag, его ответ всегда 400
+        return None
+    genre_filter = parse_genre_filter(query_params)
+    return (query_params.get('type', 'all'), cursor, limit, tuple(fields or ()),
+            tuple(genre_filter['all']), tuple(genre_filter['any']))
+
+def catalog_version_is_fresh() -> bool:
+    return (_catalog_version['value'] is not None
+            and time.monotonic() - _catalog_version['checked_at'] < CATALOG_VERSION_CHECK_SECONDS)
+
+def refresh_catalog_version(cur) -> None:
+    # Отпечаток каталога: счетчик записей админки, число строк, последнее изменение anime
+    # и последнее изменение карточек - голоса меняют rating только в карточках, не трогая версию
+    cur.execute('''
+        SELECT COALESCE((SELECT version FROM cache_versions WHERE cache_key = 'catalog'), 0) AS version,
+               COUNT(*) AS total, MAX(updated_at) AS last_updated,
+               (SELECT MAX(updated_at) FROM anime_catalog_items) AS items_updated
+        FROM anime
+    ''')
+    row = cur.fetchone()
+    last_updated = row['last_updated'].isoformat() if row['last_updated'] else ''
+    items_updated = row['items_updated'].isoformat() if row['items_updated'] else ''
+    version = f"{row['version']}-{row['total']}-{last_updated}-{items_updated}"
+    with _catalog_lock:
+        if version != _catalog_version['value']:
+            _catalog_cache.clear()
+        _catalog_version['value'] = version
+        _catalog_version['checked_at'] = time.monotonic()
+
+def catalog_cache_get(key: Tuple) -> Optional[Tuple[str, str]]:
+    with _catalog_lock:
+        entry = _catalog_cache.get(key)
+        if not entry:
+            return None
+        stored_at, version, body, etag = entry
+        if version != _catalog_version['value'] or time.monotonic() - stored_at > CATALOG_CACHE_TTL_SECONDS:
+            del _catalog_cache[key]
+            return None
+        _catalog_cache.move_to_end(key)
+        return body, etag
+
+def catalog_cache_put(key: Tuple, body: str) -> str:
+    etag = catalog_etag(body)
+    with _catalog_lock:
+        _catalog_cache[key] = (time.monotonic(), _catalog_version['value'], body, etag)
+        _catalog_cache.move_to_end(key)
+        while len(_catalog_cache) > CATALOG_CACHE_MAX_ENTRIES:
+            _catalog_cache.popitem(last=False)
+    return etag
+
+def catalog_etag(body: str) -> str:
+    # ETag от самого тела: 304 получает только клиент с теми же байтами, даже если версия каталога не сменилась
+    digest = hashlib.md5(body.encode('utf-8')).hexdigest()
+    return f'W/"{digest}"'
+
+def catalog_response(event: Dict[str, Any], headers: Dict[str, str], body: str, etag: str) -> Dict[str, Any]:
+    if etag_matches(event, etag):
+        return {
+            'statusCode': 304,
+            'headers': {**headers, 'ETag': etag},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    return compress_response(event, {
+        'statusCode': 200,
+        'headers': {**headers, 'ETag': etag},
+        'body': body,
+        'isBase64Encoded': False
+    })
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    headers = event.get('headers') or {}
+    if_none_match = headers.get('If-None-Match') or headers.get('if-none-match') or ''
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or etag[2:] in candidates
+
+def bump_catalog_version(cur) -> None:
+    # Счетчик в БД общий для всех теплых экземпляров, они сбросят свой кэш при следующей сверке
+    cur.execute('''
+        UPDATE cache_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE cache_key = 'catalog'
+    ''')
+
+def invalidate_catalog_cache() -> None:
+    with _catalog_lock:
+        _catalog_cache.clear()
+        _catalog_version['value'] = None
+
+def choose_encoding(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    accept_encoding = (headers.get('Accept-Encoding') or headers.get('accept-encoding') or '').lower()
+    accepted = set()
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip())
+    for encoding in ('br', 'gzip'):
+        if encoding in accepted:
+            return encoding
+    return None
+
+def compress_body(body: str, encoding: str) -> str:
+    raw = body.encode('utf-8')
+    if encoding == 'br':
+        data = brotli.compress(raw, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(raw, compresslevel=GZIP_LEVEL)
+    return base64.b64encode(data).decode('ascii')
+
+def compress_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    body = response.get('body') or ''
+    if response['statusCode'] != 200 or len(body) < COMPRESSION_MIN_BYTES:
+        return response
+    encoding = choose_encoding(event)
+    if not encoding:
+        return response
+    
+    etag = response['headers'].get('ETag')
+    if etag:
+        with _catalog_lock:
+            compressed = _compressed_bodies.get((etag, encoding))
+        if compressed is None:
+            compressed = compress_body(body, encoding)
+            with _catalog_lock:
+                _compressed_bodies[(etag, encoding)] = compressed
+                while len(_compressed_bodies) > CATALOG_CACHE_MAX_ENTRIES:
+                    _compressed_bodies.popitem(last=False)
+    else:
+        compressed = compress_body(body, encoding)
+    
+    return {
+        **response,
+        'headers': {**response['headers'], 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+        'body': compressed,
+        'isBase64Encoded': True
+    }
+
+def parse_anime_record(data: Dict[str, Any]) -> Tuple[Optional[Tuple], Optional[str]]:
+    title = str(data.get('title') or '').strip()
+    if not title:
+        return None, 'Название обязательно'
+    
+    try:
+        episodes = int(data.get('episodes', 12))
+        rating = round(float(data.get('rating', 8.0)), 1)
+        release_year = int(data.get('release_year', datetime.now().year))
+        duration = data.get('duration_minutes', 24)
+        duration = int(duration) if duration is not None else None
+    except (TypeError, ValueError, OverflowError):
+        return None, 'Неверный формат числовых полей'
+    
+    if len(title) > ANIME_TITLE_MAX_LENGTH:
+        return None, f'Название длиннее {ANIME_TITLE_MAX_LENGTH} символов'
+    if not 0 <= rating <= ANIME_RATING_MAX:
+        return None, f'rating должен быть от 0 до {ANIME_RATING_MAX}'
+    for value in (episodes, release_year, duration):
+        if value is not None and abs(value) > PG_INTEGER_MAX:
+            return None, 'Числовое поле вне допустимого диапазона'
+    
+    status = data.get('status', 'Онгоинг')
+    if not isinstance(status, str) or len(status) > ANIME_STATUS_MAX_LENGTH:
+        return None, f'status должен быть строкой до {ANIME_STATUS_MAX_LENGTH} символов'
+    
+    genres = data.get('genres', [])
+    if isinstance(genres, str):
+        genres = [g.strip() for g in genres.split('|') if g.strip()]
+    if not isinstance(genres, list) or not all(isinstance(g, str) for g in genres):
+        return None, 'genres должен быть списком строк'
+    
+    is_movie = data.get('is_movie', False)
+    if isinstance(is_movie, str):
+        is_movie = is_movie.strip().lower() in ('1', 'true', 'yes', 'да')
+    
+    now = datetime.now()
+    return (
+        title, str(data.get('image_url') or '').strip(), episodes, rating,
+        str(data.get('description') or '').strip(), genres, release_year,
+        status, data.get('video_quality_4k', ''),
+        data.get('video_quality_1080p', ''), data.get('video_quality_720p', ''),
+        data.get('video_quality_480p', ''), data.get('anime_type', 'series'),
+        duration, bool(is_movie), now, now
+    ), None
+
+def parse_bulk_records(data_format: str, payload: Any) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+    # Каждая запись возвращается вместе с ошибкой разбора, чтобы сообщить о ней построчно
+    if data_format == 'json':
+        if not isinstance(payload, list):
+            raise ValueError('Ожидается массив записей')
+        return [(item, None) if isinstance(item, dict) else (None, 'Запись должна быть объектом') for item in payload]
+    
+    if not isinstance(payload, str):
+        raise ValueError('Ожидается текст в формате ' + data_format)
+    
+    if data_format == 'ndjson':
+        records = []
+        for line in payload.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                records.append((item, None) if isinstance(item, dict) else (None, 'Запись должна быть объектом'))
+            except ValueError:
+                records.append((None, 'Неверный JSON'))
+        return records
+    
+    if data_format == 'csv':
+        reader = csv.DictReader(io.StringIO(payload))
+        return [({k: v for k, v in row.items() if k and v not in (None, '')}, None) for row in reader]
+    
+    raise ValueError('Неизвестный формат: ' + data_format)
+
+def bulk_import_anime(cur, records: List[Tuple[Optional[Dict[str, Any]], Optional[str]]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+    results: List[Dict[str, Any]] = []
+    valid_rows = []
+    valid_positions = []
+    
+    for position, (record, error) in enumerate(records, start=1):
+        values = None
+        if record is not None:
+            values, error = parse_anime_record(record)
+        if error:
+            results.append({'row': position, 'error': error})
+        else:
+            results.append({'row': position})
+            valid_rows.append(values)
+            valid_positions.append(len(results) - 1)
+    
+    new_ids: List[int] = []
+    if valid_rows:
+        # Одна многострочная вставка на страницу вместо отдельного INSERT и коммита на каждое аниме
+        inserted = execute_values(
+            cur,
+            f"INSERT INTO anime ({', '.join(ANIME_INSERT_COLUMNS)}) VALUES %s RETURNING id",
+            valid_rows,
+            page_size=1000,
+            fetch=True
+        )
+        new_ids = [row['id'] for row in inserted]
+        for result_index, new_id in zip(valid_positions, new_ids):
+            results[result_index]['id'] = new_id
+    
+    return results, new_ids
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     cors_headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
         'Access-Control-Max-Age': '86400',
         'Content-Type': 'application/json'
     }
@@ -48,6 +618,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    cache_key = catalog_cache_key(event.get('queryStringParameters') or {}) if method == 'GET' else None
+    if cache_key and catalog_version_is_fresh():
+        cached = catalog_cache_get(cache_key)
+        if cached is not None:
+            return catalog_response(event, cors_headers, *cached)
+    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
         return {
@@ -57,7 +633,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    conn = get_db_connection(RealDictCursor)
     cur = conn.cursor()
     
     try:
@@ -65,7 +641,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             query_params = event.get('queryStringParameters') or {}
             action = query_params.get('action', 'get_list')
             anime_type = query_params.get('type', 'all')
-            search = query_params.get('search', '')
+            search = query_params.get('search', '').strip()
+            
+            # Постраничный режим включается параметрами cursor/limit, без них отдается весь список
+            cursor = query_params.get('cursor')
+            paginated = bool(cursor) or 'limit' in query_params
+            limit = parse_page_size(query_params.get('limit')) if paginated else None
+            after = None
+            if cursor:
+                after = decode_cursor(cursor)
+                if not after:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Неверный курсор'}),
+                        'isBase64Encoded': False
+                    }
             
             if action == 'get_all':
                 admin_data = verify_admin_token(event)
@@ -77,14 +668,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                if anime_type == 'movies':
-                    cur.execute('SELECT * FROM anime WHERE is_movie = TRUE ORDER BY release_year DESC, id DESC')
-                elif anime_type == 'series':
-                    cur.execute('SELECT * FROM anime WHERE is_movie = FALSE ORDER BY release_year DESC, id DESC')
-                else:
-                    cur.execute('SELECT * FROM anime ORDER BY release_year DESC, id DESC')
+                fields, error = parse_fields(query_params.get('fields'), ADMIN_COLUMNS)
+                if error:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': error}),
+                        'isBase64Encoded': False
+                    }
                 
-                animes = [dict(row) for row in cur.fetchall()]
+                # id и release_year нужны для курсора, даже если их не запросили
+                columns = fields or ['*']
+                if fields:
+                    columns = fields + [c for c in ('id', 'release_year') if c not in fields]
+                query, params = build_list_query(columns, anime_type, after, limit)
+                cur.execute(query, params)
+                
+                animes, next_cursor = split_page([dict(row) for row in cur.fetchall()], limit)
+                if fields:
+                    animes = [{k: v for k, v in anime.items() if k in fields} for anime in animes]
                 
                 for anime in animes:
                     if anime.get('created_at'):
@@ -92,69 +694,77 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     if anime.get('updated_at'):
                         anime['updated_at'] = anime['updated_at'].isoformat()
                 
-                return {
+                response_data = {'animes': animes}
+                if paginated:
+                    response_data['next_cursor'] = next_cursor
+                
+                return compress_response(event, {
                     'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'animes': animes}),
+                    'body': json.dumps(response_data),
                     'isBase64Encoded': False
-                }
+                })
             
             else:
-                if anime_type == 'movies':
-                    if search:
-                        cur.execute(
-                            "SELECT id, title, image_url, episodes, rating, description, genres, release_year, status, is_movie, duration_minutes FROM anime WHERE is_movie = TRUE AND title ILIKE %s ORDER BY release_year DESC",
-                            (f'%{search}%',)
-                        )
-                    else:
-                        cur.execute(
-                            "SELECT id, title, image_url, episodes, rating, description, genres, release_year, status, is_movie, duration_minutes FROM anime WHERE is_movie = TRUE ORDER BY release_year DESC"
-                        )
-                elif anime_type == 'series':
-                    if search:
-                        cur.execute(
-                            "SELECT id, title, image_url, episodes, rating, description, genres, release_year, status, is_movie FROM anime WHERE is_movie = FALSE AND title ILIKE %s ORDER BY release_year DESC",
-                            (f'%{search}%',)
-                        )
-                    else:
-                        cur.execute(
-                            "SELECT id, title, image_url, episodes, rating, description, genres, release_year, status, is_movie FROM anime WHERE is_movie = FALSE ORDER BY release_year DESC"
-                        )
-                else:
-                    if search:
-                        cur.execute(
-                            "SELECT id, title, image_url, episodes, rating, description, genres, release_year, status, is_movie, duration_minutes FROM anime WHERE title ILIKE %s ORDER BY release_year DESC",
-                            (f'%{search}%',)
-                        )
-                    else:
-                        cur.execute(
-                            "SELECT id, title, image_url, episodes, rating, description, genres, release_year, status, is_movie, duration_minutes FROM anime ORDER BY release_year DESC"
-                        )
-                
-                rows = cur.fetchall()
-                anime_list = []
-                for row in rows:
-                    anime_dict = dict(row)
-                    anime_list.append({
-                        'id': str(anime_dict['id']),
-                        'title': anime_dict['title'],
-                        'image': anime_dict['image_url'],
-                        'episodes': anime_dict['episodes'],
-                        'rating': float(anime_dict['rating']) if anime_dict['rating'] else 0.0,
-                        'description': anime_dict['description'],
-                        'genres': anime_dict['genres'] if anime_dict['genres'] else [],
-                        'releaseYear': anime_dict['release_year'],
-                        'status': anime_dict['status'],
-                        'isMovie': anime_dict.get('is_movie', False),
-                        'duration': anime_dict.get('duration_minutes')
+                fields, error = parse_fields(query_params.get('fields'), list(CARD_FIELD_COLUMNS))
+                if error:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': error}),
+                        'isBase64Encoded': False
+                    }
+                
+                genre_filter = parse_genre_filter(query_params)
+                
+                if search:
+                    # Поиск возвращает лучшие совпадения по релевантности, курсор к нему не применяется
+                    if cursor:
+                        return {
+                            'statusCode': 400,
+                            'headers': cors_headers,
+                            'body': json.dumps({'error': 'Курсор не поддерживается вместе с search, используйте limit'}),
+                            'isBase64Encoded': False
+                        }
+                    columns = [CARD_FIELD_COLUMNS[field] for field in (fields or CARD_FIELD_COLUMNS)]
+                    if 'id' not in columns:
+                        columns.insert(0, 'id')
+                    query, search_params = build_search_query(
+                        columns, anime_type, search,
+                        parse_page_size(query_params.get('limit'), DEFAULT_SEARCH_LIMIT),
+                        genre_filter
+                    )
+                    cur.execute(query, search_params)
+                    anime_list = [serialize_anime(dict(row), fields) for row in cur.fetchall()]
+                    
+                    return compress_response(event, {
+                        'statusCode': 200,
+                        'headers': cors_headers,
+                        'body': json.dumps({'anime': anime_list}),
+                        'isBase64Encoded': False
                     })
                 
-                return {
-                    'statusCode': 200,
-                    'headers': cors_headers,
-                    'body': json.dumps({'anime': anime_list}),
-                    'isBase64Encoded': False
-                }
+                if not catalog_version_is_fresh():
+                    refresh_catalog_version(cur)
+                    cached = catalog_cache_get(cache_key)
+                    if cached is not None:
+                        return catalog_response(event, cors_headers, *cached)
+                
+                # Карточки уже сериализованы в anime_catalog_items, остается склеить их в ответ
+                query, params = build_snapshot_query(anime_type, after, limit, fields, genre_filter)
+                cur.execute(query, params)
+                if limit is None:
+                    items_json, next_cursor = cur.fetchone()['items'], None
+                else:
+                    rows, next_cursor = split_page(cur.fetchall(), limit)
+                    items_json = ', '.join(row['item'] for row in rows)
+                
+                extra_json = {'facets': get_catalog_facets(cur, anime_type, genre_filter)}
+                if paginated:
+                    extra_json['next_cursor'] = json.dumps(next_cursor)
+                body = render_catalog_body(items_json, extra_json)
+                etag = catalog_cache_put(cache_key, body)
+                return catalog_response(event, cors_headers, body, etag)
         
         elif method == 'POST':
             admin_data = verify_admin_token(event)
@@ -166,52 +776,94 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            body_data = json.loads(event.get('body', '{}'))
+            query_params = event.get('queryStringParameters') or {}
+            if query_params.get('action') == 'bulk_import':
+                # NDJSON или CSV можно прислать телом запроса как есть
+                raw_body = event.get('body') or ''
+                if event.get('isBase64Encoded'):
+                    raw_body = base64.b64decode(raw_body).decode('utf-8')
+                body_data = {'action': 'bulk_import', 'format': query_params.get('format', 'ndjson'), 'data': raw_body}
+            else:
+                body_data = json.loads(event.get('body', '{}'))
             action = body_data.get('action', '')
             
-            if action == 'add_anime':
-                title = body_data.get('title', '').strip()
-                image_url = body_data.get('image_url', '').strip()
-                episodes = int(body_data.get('episodes', 12))
-                rating = float(body_data.get('rating', 8.0))
-                description = body_data.get('description', '').strip()
-                genres = body_data.get('genres', [])
-                release_year = int(body_data.get('release_year', datetime.now().year))
-                status = body_data.get('status', 'Онгоинг')
-                video_4k = body_data.get('video_quality_4k', '')
-                video_1080p = body_data.get('video_quality_1080p', '')
-                video_720p = body_data.get('video_quality_720p', '')
-                video_480p = body_data.get('video_quality_480p', '')
-                anime_type = body_data.get('anime_type', 'series')
-                duration = body_data.get('duration_minutes', 24)
-                is_movie = body_data.get('is_movie', False)
-                
-                if not title:
+            if action == 'bulk_import':
+                data_format = body_data.get('format', 'json')
+                payload = body_data.get('animes') if data_format == 'json' else body_data.get('data')
+                try:
+                    records = parse_bulk_records(data_format, payload)
+                except ValueError as e:
                     return {
                         'statusCode': 400,
                         'headers': cors_headers,
-                        'body': json.dumps({'error': 'Название обязательно'}),
+                        'body': json.dumps({'error': str(e)}),
                         'isBase64Encoded': False
                     }
                 
-                cur.execute('''
-                    INSERT INTO anime (
-                        title, image_url, episodes, rating, description, genres, 
-                        release_year, status, video_quality_4k, video_quality_1080p,
-                        video_quality_720p, video_quality_480p, anime_type, 
-                        duration_minutes, is_movie, created_at, updated_at
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                if not records or len(records) > BULK_IMPORT_MAX_ROWS:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': f'Нужно от 1 до {BULK_IMPORT_MAX_ROWS} записей'}),
+                        'isBase64Encoded': False
+                    }
+                
+                try:
+                    results, new_ids = bulk_import_anime(cur, records)
+                    if new_ids:
+                        refresh_catalog_items(cur, new_ids)
+                        bump_catalog_version(cur)
+                    conn.commit()
+                except psycopg2.Error as e:
+                    # Пачка вставляется одним оператором, поэтому при ошибке БД не сохраняется ни одна строка
+                    conn.rollback()
+                    client_error = isinstance(e, (psycopg2.DataError, psycopg2.IntegrityError))
+                    return {
+                        'statusCode': 400 if client_error else 500,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'Импорт отменен: ошибка базы данных',
+                            'details': (e.pgerror or str(e)).strip(),
+                            'inserted': 0
+                        }),
+                        'isBase64Encoded': False
+                    }
+                if new_ids:
+                    invalidate_catalog_cache()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': cors_headers,
+                    'body': json.dumps({
+                        'success': bool(new_ids),
+                        'inserted': len(new_ids),
+                        'failed': len(results) - len(new_ids),
+                        'results': results
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            elif action == 'add_anime':
+                values, error = parse_anime_record(body_data)
+                if error:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': error}),
+                        'isBase64Encoded': False
+                    }
+                
+                cur.execute(f'''
+                    INSERT INTO anime ({', '.join(ANIME_INSERT_COLUMNS)})
+                    VALUES ({', '.join(['%s'] * len(ANIME_INSERT_COLUMNS))})
                     RETURNING id
-                ''', (
-                    title, image_url, episodes, rating, description, genres,
-                    release_year, status, video_4k, video_1080p, video_720p,
-                    video_480p, anime_type, duration, is_movie, 
-                    datetime.now(), datetime.now()
-                ))
+                ''', values)
                 
                 new_id = cur.fetchone()['id']
+                refresh_catalog_items(cur, [new_id])
+                bump_catalog_version(cur)
                 conn.commit()
+                invalidate_catalog_cache()
                 
                 return {
                     'statusCode': 200,
@@ -271,7 +923,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 query = f"UPDATE anime SET {', '.join(update_fields)} WHERE id = %s"
                 cur.execute(query, update_values)
                 
+                refresh_catalog_items(cur, [anime_id])
+                bump_catalog_version(cur)
                 conn.commit()
+                invalidate_catalog_cache()
                 
                 return {
                     'statusCode': 200,
@@ -293,7 +948,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 cur.execute('UPDATE anime SET status = %s, updated_at = %s WHERE id = %s', 
                            ('Удалено', datetime.now(), anime_id))
                 
+                refresh_catalog_items(cur, [anime_id])
+                bump_catalog_version(cur)
                 conn.commit()
+                invalidate_catalog_cache()
                 
                 return {
                     'statusCode': 200,
@@ -328,7 +986,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 query = f"UPDATE anime SET {quality_field} = '', updated_at = %s WHERE id = %s"
                 cur.execute(query, (datetime.now(), anime_id))
                 
+                bump_catalog_version(cur)
                 conn.commit()
+                invalidate_catalog_cache()
                 
                 return {
                     'statusCode': 200,
@@ -346,4 +1006,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
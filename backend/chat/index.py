@@ -4,17 +4,49 @@ Args: event - запрос с методом и параметрами; context
 Returns: HTTP ответ с сообщениями, друзьями или статусом операции
 '''
 
+import base64
+import hashlib
 import json
+from collections import OrderedDict
 import os
-from datetime import datetime
-from typing import Dict, Any
+import select
+import time
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from db_pool import get_db_connection, release_db_connection
+from triggers import is_timer_event
 import uuid
 
-def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+MAX_MESSAGES_LIMIT = 200
+CHAT_LONG_POLL_MAX_SECONDS = int(os.environ.get('CHAT_LONG_POLL_MAX_SECONDS', '25'))
+PUBLIC_CHAT_CHANNEL = 'chat_public'
+# Чтение по умолчанию сначала смотрит только в последние секции, старые затрагиваются при нехватке строк
+CHAT_RECENT_DAYS = int(os.environ.get('CHAT_RECENT_DAYS', '30'))
+CHAT_PARTITIONS_AHEAD = int(os.environ.get('CHAT_PARTITIONS_AHEAD', '2'))
+CHAT_RETENTION_MONTHS = int(os.environ.get('CHAT_RETENTION_MONTHS', '12'))
+CHAT_ARCHIVE_CHUNK_ROWS = int(os.environ.get('CHAT_ARCHIVE_CHUNK_ROWS', '1000'))
+CHAT_ARCHIVE_LOCK_TIMEOUT_MS = int(os.environ.get('CHAT_ARCHIVE_LOCK_TIMEOUT_MS', '2000'))
+USERS_PAGE_SIZE = 50
+USERS_MAX_PAGE_SIZE = 100
+PROFILE_CACHE_TTL_SECONDS = int(os.environ.get('PROFILE_CACHE_TTL', '60'))
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get('PROFILE_CACHE_MAX_ENTRIES', '1024'))
+PROFILE_VERSION_CHECK_SECONDS = int(os.environ.get('PROFILE_VERSION_CHECK_SECONDS', '5'))
+FRIENDS_CACHE_TTL_SECONDS = int(os.environ.get('FRIENDS_CACHE_TTL', '300'))
+FRIENDS_CACHE_MAX_ENTRIES = int(os.environ.get('FRIENDS_CACHE_MAX_ENTRIES', '2048'))
+FRIENDS_VERSION_CHECK_SECONDS = int(os.environ.get('FRIENDS_VERSION_CHECK_SECONDS', '5'))
+
+# Профили авторов для денормализации в chat_messages; сбрасываются по версии user_profiles из cache_versions
+_profile_cache: 'OrderedDict[str, Tuple[float, Any, Dict[str, Any]]]' = OrderedDict()
+_profile_version: Dict[str, Any] = {'value': None, 'checked_at': 0.0}
+_profile_lock = threading.Lock()
+
+# Принятые друзья пользователя; сбрасываются по версии friendships из cache_versions
+_friends_cache: 'OrderedDict[str, Tuple[float, Any, frozenset]]' = OrderedDict()
+_friends_version: Dict[str, Any] = {'value': None, 'checked_at': 0.0}
+_friends_lock = threading.Lock()
 
 def verify_token(event: Dict) -> Dict[str, Any]:
     import jwt
@@ -31,7 +63,263 @@ def verify_token(event: Dict) -> Dict[str, Any]:
     except jwt.InvalidTokenError:
         return {'error': 'Invalid token'}
 
+# Подтверждение прочтения до up_to_id: отметка продвигается только вперед и не дальше последнего сообщения пары,
+# поэтому повторные подтверждения ничего не переписывают. Счетчик уменьшается на число реально отмеченных строк,
+# чтобы не затереть инкремент от параллельной отправки.
+MARK_READ_QUERY = '''
+    WITH previous AS (
+        SELECT last_read_id, LEAST(%(up_to_id)s, COALESCE(last_message_id, 0)) AS up_to_id
+        FROM private_conversations
+        WHERE user_id = %(user_id)s AND peer_id = %(friend_id)s
+    ),
+    flags AS (
+        UPDATE private_messages m
+        SET is_read = TRUE
+        FROM previous
+        WHERE LEAST(m.sender_id, m.recipient_id) = LEAST(%(user_id)s::varchar, %(friend_id)s::varchar)
+          AND GREATEST(m.sender_id, m.recipient_id) = GREATEST(%(user_id)s::varchar, %(friend_id)s::varchar)
+          AND m.sender_id = %(friend_id)s
+          AND m.id > previous.last_read_id
+          AND m.id <= previous.up_to_id
+          AND m.is_read = FALSE
+        RETURNING m.id
+    ),
+    ack AS (
+        UPDATE private_conversations c
+        SET last_read_id = previous.up_to_id,
+            unread_count = GREATEST(c.unread_count - (SELECT COUNT(*) FROM flags), 0)
+        FROM previous
+        WHERE c.user_id = %(user_id)s AND c.peer_id = %(friend_id)s AND c.last_read_id < previous.up_to_id
+        RETURNING c.last_read_id, c.unread_count
+    )
+    SELECT (SELECT COUNT(*) FROM flags) AS marked,
+           COALESCE((SELECT last_read_id FROM ack), (SELECT last_read_id FROM previous), 0) AS last_read_id,
+           COALESCE((SELECT unread_count FROM ack),
+                    (SELECT unread_count FROM private_conversations
+                     WHERE user_id = %(user_id)s AND peer_id = %(friend_id)s), 0) AS unread_count
+'''
+
+def fetch_rows(cur, query: str, params: Tuple) -> List[Dict[str, Any]]:
+    cur.execute(query, params)
+    return [dict(row) for row in cur.fetchall()]
+
+def friends_version_is_fresh() -> bool:
+    return (_friends_version['value'] is not None
+            and time.monotonic() - _friends_version['checked_at'] < FRIENDS_VERSION_CHECK_SECONDS)
+
+def refresh_friends_version(cur) -> None:
+    cur.execute("SELECT COALESCE((SELECT version FROM cache_versions WHERE cache_key = 'friendships'), 0) AS version")
+    version = cur.fetchone()['version']
+    with _friends_lock:
+        if version != _friends_version['value']:
+            _friends_cache.clear()
+        _friends_version['value'] = version
+        _friends_version['checked_at'] = time.monotonic()
+
+def get_friend_ids(cur, user_id: str) -> frozenset:
+    if not friends_version_is_fresh():
+        refresh_friends_version(cur)
+    
+    with _friends_lock:
+        entry = _friends_cache.get(user_id)
+        if entry:
+            stored_at, version, friend_ids = entry
+            if version == _friends_version['value'] and time.monotonic() - stored_at <= FRIENDS_CACHE_TTL_SECONDS:
+                _friends_cache.move_to_end(user_id)
+                return friend_ids
+            del _friends_cache[user_id]
+    
+    cur.execute('''
+        SELECT friend_id AS id FROM friends WHERE user_id = %s AND status = 'accepted'
+        UNION
+        SELECT user_id AS id FROM friends WHERE friend_id = %s AND status = 'accepted'
+    ''', (user_id, user_id))
+    friend_ids = frozenset(row['id'] for row in cur.fetchall())
+    
+    with _friends_lock:
+        _friends_cache[user_id] = (time.monotonic(), _friends_version['value'], friend_ids)
+        _friends_cache.move_to_end(user_id)
+        while len(_friends_cache) > FRIENDS_CACHE_MAX_ENTRIES:
+            _friends_cache.popitem(last=False)
+    return friend_ids
+
+def invalidate_friends(cur, user_ids: List[str], bump_version: bool = True) -> None:
+    # Локально сбрасываем сразу, другие экземпляры узнают о смене по версии после commit
+    with _friends_lock:
+        for user_id in user_ids:
+            _friends_cache.pop(user_id, None)
+    if bump_version:
+        cur.execute('''
+            UPDATE cache_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE cache_key = 'friendships'
+        ''')
+
+def fetch_newest_rows(cur, query: str, params: Tuple) -> List[Dict[str, Any]]:
+    # query содержит {window}, последний параметр - LIMIT; старые секции читаются, только если свежих строк не хватило
+    limit = params[-1]
+    cutoff = datetime.now() - timedelta(days=CHAT_RECENT_DAYS)
+    rows = fetch_rows(cur, query.format(window='AND created_at >= %s'), params[:-1] + (cutoff, limit))
+    if len(rows) < limit:
+        rows += fetch_rows(cur, query.format(window='AND created_at < %s'), params[:-1] + (cutoff, limit - len(rows)))
+    return rows
+
+def run_chat_maintenance(conn: Any, cur, retention_months: int) -> int:
+    cur.execute(
+        'SELECT chat_maintenance(%s, %s, %s) AS archived',
+        (CHAT_PARTITIONS_AHEAD, retention_months, CHAT_ARCHIVE_CHUNK_ROWS)
+    )
+    archived = cur.fetchone()['archived']
+    conn.commit()
+    return archived
+
+def run_scheduled_maintenance() -> Dict[str, Any]:
+    # Создание секций и архивация только по таймеру: ATTACH и DROP берут сильные блокировки на таблицы чата,
+    # lock_timeout не дает им надолго встать в очередь перед запросами пользователей
+    conn = get_db_connection(RealDictCursor)
+    cur = conn.cursor()
+    try:
+        cur.execute('SET LOCAL lock_timeout = %s', (f'{CHAT_ARCHIVE_LOCK_TIMEOUT_MS}ms',))
+        archived = run_chat_maintenance(conn, cur, CHAT_RETENTION_MONTHS)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f'Chat archive failed: {e}')
+        return {'statusCode': 500, 'body': json.dumps({'error': 'Chat archive failed'})}
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    if archived:
+        print(f'Chat maintenance archived {archived} partitions')
+    return {'statusCode': 200, 'body': json.dumps({'archived': archived})}
+
+def private_chat_channel(user_id: str) -> str:
+    # Имя канала LISTEN - идентификатор, поэтому id пользователя в него не подставляется напрямую
+    return 'chat_user_' + hashlib.md5(str(user_id).encode()).hexdigest()[:16]
+
+def parse_wait_seconds(value: Any) -> float:
+    try:
+        wait = float(value) if value else 0.0
+    except ValueError:
+        wait = 0.0
+    return max(0.0, min(wait, CHAT_LONG_POLL_MAX_SECONDS))
+
+def wait_for_messages(conn: Any, cur, channel: str, fetch: Callable[[], List[Dict[str, Any]]], wait_seconds: float) -> List[Dict[str, Any]]:
+    messages = fetch()
+    if messages or wait_seconds <= 0:
+        return messages
+    
+    deadline = time.monotonic() + wait_seconds
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cur.execute(f'LISTEN {channel}')
+        # Повторная выборка после LISTEN закрывает окно между первым запросом и подпиской
+        messages = fetch()
+        while not messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if select.select([conn], [], [], remaining) == ([], [], []):
+                break
+            conn.poll()
+            if conn.notifies:
+                del conn.notifies[:]
+                messages = fetch()
+    finally:
+        # Соединение вернется в пул, подписка и накопленные уведомления ему не нужны
+        try:
+            cur.execute('UNLISTEN *')
+            del conn.notifies[:]
+            conn.autocommit = False
+        except psycopg2.Error:
+            pass
+    return messages
+
+def update_conversations(cur, message: Dict[str, Any]) -> None:
+    sender_id, recipient_id = message['sender_id'], message['recipient_id']
+    # Строки пары всегда блокируются в одном порядке, иначе встречные отправки могут взаимно заблокироваться
+    rows = sorted([(sender_id, recipient_id, 0), (recipient_id, sender_id, 1)])
+    # Отправки одной пары могут закоммититься не в порядке id: последнее сообщение меняется только на более новое,
+    # а счетчик непрочитанных растет всегда
+    cur.execute('''
+        INSERT INTO private_conversations (user_id, peer_id, last_message_id, last_message, last_sender_id, last_message_at, unread_count)
+        VALUES (%s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (user_id, peer_id) DO UPDATE SET
+            last_message_id = GREATEST(private_conversations.last_message_id, EXCLUDED.last_message_id),
+            last_message = CASE WHEN private_conversations.last_message_id IS NULL OR EXCLUDED.last_message_id > private_conversations.last_message_id
+                                THEN EXCLUDED.last_message ELSE private_conversations.last_message END,
+            last_sender_id = CASE WHEN private_conversations.last_message_id IS NULL OR EXCLUDED.last_message_id > private_conversations.last_message_id
+                                  THEN EXCLUDED.last_sender_id ELSE private_conversations.last_sender_id END,
+            last_message_at = CASE WHEN private_conversations.last_message_id IS NULL OR EXCLUDED.last_message_id > private_conversations.last_message_id
+                                   THEN EXCLUDED.last_message_at ELSE private_conversations.last_message_at END,
+            unread_count = private_conversations.unread_count + EXCLUDED.unread_count
+    ''', tuple(
+        value
+        for user_id, peer_id, unread in rows
+        for value in (user_id, peer_id, message['id'], message['message'], sender_id, message['created_at'], unread)
+    ))
+
+def profile_version_is_fresh() -> bool:
+    return (_profile_version['value'] is not None
+            and time.monotonic() - _profile_version['checked_at'] < PROFILE_VERSION_CHECK_SECONDS)
+
+def refresh_profile_version(cur) -> None:
+    cur.execute("SELECT COALESCE((SELECT version FROM cache_versions WHERE cache_key = 'user_profiles'), 0) AS version")
+    version = cur.fetchone()['version']
+    with _profile_lock:
+        if version != _profile_version['value']:
+            _profile_cache.clear()
+        _profile_version['value'] = version
+        _profile_version['checked_at'] = time.monotonic()
+
+def get_author_profile(cur, user_id: str) -> Optional[Dict[str, Any]]:
+    if not profile_version_is_fresh():
+        refresh_profile_version(cur)
+    
+    with _profile_lock:
+        entry = _profile_cache.get(user_id)
+        if entry:
+            stored_at, version, profile = entry
+            if version == _profile_version['value'] and time.monotonic() - stored_at <= PROFILE_CACHE_TTL_SECONDS:
+                _profile_cache.move_to_end(user_id)
+                return profile
+            del _profile_cache[user_id]
+    
+    cur.execute('''
+        SELECT id, username, avatar_url
+        FROM users
+        WHERE id = %s
+    ''', (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    
+    profile = dict(row)
+    with _profile_lock:
+        _profile_cache[user_id] = (time.monotonic(), _profile_version['value'], profile)
+        _profile_cache.move_to_end(user_id)
+        while len(_profile_cache) > PROFILE_CACHE_MAX_ENTRIES:
+            _profile_cache.popitem(last=False)
+    return profile
+
+def encode_user_cursor(sort_name: str, user_id: str) -> str:
+    raw = json.dumps([sort_name, user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_user_cursor(cursor: str) -> Optional[Tuple[str, str]]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_name, user_id = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return str(sort_name), str(user_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        return None
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if 'httpMethod' not in event:
+        # Обслуживание запускает только триггер-таймер; прочие вызовы без HTTP отклоняются
+        if not is_timer_event(event):
+            return {'statusCode': 400, 'body': json.dumps({'error': 'Unsupported event'})}
+        return run_scheduled_maintenance()
+    
     method = event.get('httpMethod', 'GET')
     
     cors_headers = {
@@ -59,422 +347,576 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    conn = get_db_connection()
+    conn = get_db_connection(RealDictCursor)
     cur = conn.cursor()
     
-    if method == 'GET':
-        query_params = event.get('queryStringParameters') or {}
-        action = query_params.get('action', 'get_messages')
-        
-        if action == 'get_messages':
-            limit = int(query_params.get('limit', '50'))
-            cur.execute('''
-                SELECT id, user_id, username, avatar_url, message, created_at
-                FROM chat_messages
-                WHERE is_active = TRUE
-                ORDER BY created_at DESC
-                LIMIT %s
-            ''', (limit,))
-            
-            messages = [dict(row) for row in cur.fetchall()]
-            messages.reverse()
-            
-            for msg in messages:
-                if msg['created_at']:
-                    msg['created_at'] = msg['created_at'].isoformat()
-            
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'messages': messages}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'get_private_messages':
-            friend_id = query_params.get('friend_id')
-            if not friend_id:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': cors_headers,
-                    'body': json.dumps({'error': 'friend_id required'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute('''
-                SELECT id, sender_id, recipient_id, message, created_at, is_read
-                FROM private_messages
-                WHERE (sender_id = %s AND recipient_id = %s)
-                   OR (sender_id = %s AND recipient_id = %s)
-                ORDER BY created_at ASC
-                LIMIT 100
-            ''', (user_data['user_id'], friend_id, friend_id, user_data['user_id']))
-            
-            messages = [dict(row) for row in cur.fetchall()]
-            for msg in messages:
-                if msg['created_at']:
-                    msg['created_at'] = msg['created_at'].isoformat()
-            
-            cur.execute('''
-                UPDATE private_messages
-                SET is_read = TRUE
-                WHERE recipient_id = %s AND sender_id = %s AND is_read = FALSE
-            ''', (user_data['user_id'], friend_id))
-            conn.commit()
-            
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'messages': messages}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'get_friends':
-            cur.execute('''
-                SELECT u.id, u.username, u.avatar_url, f.status, f.created_at
-                FROM friends f
-                JOIN users u ON (f.friend_id = u.id)
-                WHERE f.user_id = %s AND f.status = 'accepted'
-                ORDER BY u.username ASC
-            ''', (user_data['user_id'],))
-            
-            friends = [dict(row) for row in cur.fetchall()]
-            for friend in friends:
-                if friend['created_at']:
-                    friend['created_at'] = friend['created_at'].isoformat()
-            
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'friends': friends}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'get_friend_requests':
-            cur.execute('''
-                SELECT u.id, u.username, u.avatar_url, f.created_at, f.status
-                FROM friends f
-                JOIN users u ON (f.user_id = u.id)
-                WHERE f.friend_id = %s AND f.status = 'pending'
-                ORDER BY f.created_at DESC
-            ''', (user_data['user_id'],))
-            
-            requests = [dict(row) for row in cur.fetchall()]
-            for req in requests:
-                if req['created_at']:
-                    req['created_at'] = req['created_at'].isoformat()
-            
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'requests': requests}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'get_all_users':
-            cur.execute('''
-                SELECT id, username, avatar_url, is_admin
-                FROM users
-                WHERE id != %s
-                ORDER BY username ASC
-            ''', (user_data['user_id'],))
-            
-            users = [dict(row) for row in cur.fetchall()]
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'users': users}),
-                'isBase64Encoded': False
-            }
-    
-    elif method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        action = body_data.get('action', '')
-        
-        if action == 'send_message':
-            message = body_data.get('message', '').strip()
-            
-            if not message:
-                conn.close()
+    try:
+        if method == 'GET':
+            query_params = event.get('queryStringParameters') or {}
+            action = query_params.get('action', 'get_messages')
+            
+            if action == 'get_messages':
+                limit = max(1, min(int(query_params.get('limit', '50')), MAX_MESSAGES_LIMIT))
+                after_id = query_params.get('after_id')
+                since = query_params.get('since')
+                before_id = query_params.get('before')
+                
+                after_created_at = None
+                if after_id:
+                    cur.execute('SELECT created_at FROM chat_messages WHERE id = %s', (after_id,))
+                    anchor = cur.fetchone()
+                    if anchor:
+                        after_created_at = anchor['created_at']
+                    else:
+                        # Сообщение курсора удалено или ушло в архив: отдаем свежую страницу, клиент продолжит от нее
+                        after_id = None
+                
+                # Курсоры по (created_at, id): id - UUID, поэтому одного времени для порядка недостаточно
+                if after_id or since:
+                    if after_id:
+                        # Отдельное условие по created_at позволяет отсечь старые секции
+                        cursor_condition = 'created_at >= %s AND (created_at, id) > (%s, %s)'
+                        cursor_params = (after_created_at, after_created_at, after_id)
+                    else:
+                        try:
+                            cursor_params = (datetime.fromisoformat(since.replace('Z', '+00:00')),)
+                        except ValueError:
+                            return {
+                                'statusCode': 400,
+                                'headers': cors_headers,
+                                'body': json.dumps({'error': 'Некорректный параметр since'}),
+                                'isBase64Encoded': False
+                            }
+                        cursor_condition = 'created_at > %s'
+                    # С wait запрос ждет новых сообщений до N секунд вместо частого опроса
+                    messages = wait_for_messages(conn, cur, PUBLIC_CHAT_CHANNEL, lambda: fetch_rows(cur, f'''
+                        SELECT id, user_id, username, avatar_url, message, created_at
+                        FROM chat_messages
+                        WHERE is_active = TRUE AND {cursor_condition}
+                        ORDER BY created_at ASC, id ASC
+                        LIMIT %s
+                    ''', cursor_params + (limit + 1,)), parse_wait_seconds(query_params.get('wait')))
+                    has_more = len(messages) > limit
+                    messages = messages[:limit]
+                else:
+                    before_condition = ''
+                    before_params: Tuple = ()
+                    if before_id:
+                        before_condition = '''
+                            AND created_at <= (SELECT created_at FROM chat_messages WHERE id = %s)
+                            AND (created_at, id) < (SELECT created_at, id FROM chat_messages WHERE id = %s)
+                        '''
+                        before_params = (before_id, before_id)
+                    messages = fetch_newest_rows(cur, f'''
+                        SELECT id, user_id, username, avatar_url, message, created_at
+                        FROM chat_messages
+                        WHERE is_active = TRUE {before_condition} {{window}}
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT %s
+                    ''', before_params + (limit + 1,))
+                    has_more = len(messages) > limit
+                    messages = messages[:limit]
+                    messages.reverse()
+                
+                for msg in messages:
+                    if msg['created_at']:
+                        msg['created_at'] = msg['created_at'].isoformat()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Сообщение не может быть пустым'}),
+                    'body': json.dumps({'messages': messages, 'has_more': has_more}),
                     'isBase64Encoded': False
                 }
             
-            if len(message) > 500:
-                conn.close()
+            elif action == 'get_private_messages':
+                friend_id = query_params.get('friend_id')
+                if not friend_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'friend_id required'}),
+                        'isBase64Encoded': False
+                    }
+                
+                limit = max(1, min(int(query_params.get('limit', '50')), MAX_MESSAGES_LIMIT))
+                after_id = query_params.get('after_id')
+                before_id = query_params.get('before')
+                if (after_id and not after_id.isdigit()) or (before_id and not before_id.isdigit()):
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Некорректный курсор сообщений'}),
+                        'isBase64Encoded': False
+                    }
+                
+                # Пара всегда упорядочена через LEAST/GREATEST, как в индексе idx_private_messages_conversation
+                conversation_filter = '''
+                    LEAST(sender_id, recipient_id) = LEAST(%s::varchar, %s::varchar)
+                    AND GREATEST(sender_id, recipient_id) = GREATEST(%s::varchar, %s::varchar)
+                '''
+                pair = (user_data['user_id'], friend_id, user_data['user_id'], friend_id)
+                
+                if after_id:
+                    messages = wait_for_messages(conn, cur, private_chat_channel(user_data['user_id']), lambda: fetch_rows(cur, f'''
+                        SELECT id, sender_id, recipient_id, message, created_at, is_read
+                        FROM private_messages
+                        WHERE {conversation_filter} AND id > %s
+                        ORDER BY id ASC
+                        LIMIT %s
+                    ''', pair + (int(after_id), limit + 1)), parse_wait_seconds(query_params.get('wait')))
+                    has_more = len(messages) > limit
+                    messages = messages[:limit]
+                else:
+                    # Новые сообщения первыми: открытие диалога не зависит от длины истории
+                    before_condition = 'AND id < %s' if before_id else ''
+                    messages = fetch_newest_rows(cur, f'''
+                        SELECT id, sender_id, recipient_id, message, created_at, is_read
+                        FROM private_messages
+                        WHERE {conversation_filter} {before_condition} {{window}}
+                        ORDER BY id DESC
+                        LIMIT %s
+                    ''', pair + ((int(before_id),) if before_id else ()) + (limit + 1,))
+                    has_more = len(messages) > limit
+                    messages = messages[:limit]
+                    messages.reverse()
+                
+                for msg in messages:
+                    if msg['created_at']:
+                        msg['created_at'] = msg['created_at'].isoformat()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Сообщение слишком длинное (макс. 500 символов)'}),
+                    'body': json.dumps({'messages': messages, 'has_more': has_more}),
                     'isBase64Encoded': False
                 }
             
-            cur.execute('''
-                SELECT id, username, avatar_url
-                FROM users
-                WHERE id = %s
-            ''', (user_data['user_id'],))
-            
-            user = cur.fetchone()
-            if not user:
-                conn.close()
+            elif action == 'get_conversations':
+                limit = max(1, min(int(query_params.get('limit', '50')), MAX_MESSAGES_LIMIT))
+                cur.execute('''
+                    SELECT c.peer_id, u.username, u.avatar_url, c.last_message_id, c.last_message,
+                           c.last_sender_id, c.last_message_at, c.unread_count,
+                           SUM(c.unread_count) OVER () AS total_unread
+                    FROM private_conversations c
+                    JOIN users u ON u.id = c.peer_id
+                    WHERE c.user_id = %s
+                    ORDER BY c.last_message_at DESC
+                    LIMIT %s
+                ''', (user_data['user_id'], limit))
+                
+                conversations = [dict(row) for row in cur.fetchall()]
+                total_unread = int(conversations[0]['total_unread']) if conversations else 0
+                for conversation in conversations:
+                    del conversation['total_unread']
+                    if conversation['last_message_at']:
+                        conversation['last_message_at'] = conversation['last_message_at'].isoformat()
+                
                 return {
-                    'statusCode': 404,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Пользователь не найден'}),
+                    'body': json.dumps({
+                        'conversations': conversations,
+                        'total_unread': total_unread
+                    }),
                     'isBase64Encoded': False
                 }
             
-            message_id = str(uuid.uuid4())
-            now = datetime.now()
-            
-            cur.execute('''
-                INSERT INTO chat_messages (id, user_id, username, avatar_url, message, created_at, is_active)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                RETURNING id, user_id, username, avatar_url, message, created_at
-            ''', (message_id, user['id'], user['username'], user['avatar_url'], message, now, True))
-            
-            new_message = dict(cur.fetchone())
-            if new_message['created_at']:
-                new_message['created_at'] = new_message['created_at'].isoformat()
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'message': new_message, 'success': True}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'send_private_message':
-            recipient_id = body_data.get('recipient_id', '').strip()
-            message = body_data.get('message', '').strip()
-            
-            if not message or not recipient_id:
-                conn.close()
+            elif action == 'get_friends':
+                cur.execute('''
+                    SELECT u.id, u.username, u.avatar_url, f.status, f.created_at
+                    FROM friends f
+                    JOIN users u ON (f.friend_id = u.id)
+                    WHERE f.user_id = %s AND f.status = 'accepted'
+                    ORDER BY u.username ASC
+                ''', (user_data['user_id'],))
+                
+                friends = [dict(row) for row in cur.fetchall()]
+                for friend in friends:
+                    if friend['created_at']:
+                        friend['created_at'] = friend['created_at'].isoformat()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Сообщение и ID получателя обязательны'}),
+                    'body': json.dumps({'friends': friends}),
                     'isBase64Encoded': False
                 }
             
-            if len(message) > 500:
-                conn.close()
+            elif action == 'get_friend_requests':
+                cur.execute('''
+                    SELECT u.id, u.username, u.avatar_url, f.created_at, f.status
+                    FROM friends f
+                    JOIN users u ON (f.user_id = u.id)
+                    WHERE f.friend_id = %s AND f.status = 'pending'
+                    ORDER BY f.created_at DESC
+                ''', (user_data['user_id'],))
+                
+                requests = [dict(row) for row in cur.fetchall()]
+                for req in requests:
+                    if req['created_at']:
+                        req['created_at'] = req['created_at'].isoformat()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Сообщение слишком длинное'}),
+                    'body': json.dumps({'requests': requests}),
                     'isBase64Encoded': False
                 }
             
-            cur.execute('''
-                SELECT COUNT(*) as cnt FROM friends
-                WHERE ((user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s))
-                  AND status = 'accepted'
-            ''', (user_data['user_id'], recipient_id, recipient_id, user_data['user_id']))
-            
-            friendship = cur.fetchone()
-            if friendship['cnt'] == 0:
-                conn.close()
+            elif action == 'get_all_users':
+                limit = max(1, min(int(query_params.get('limit', str(USERS_PAGE_SIZE))), USERS_MAX_PAGE_SIZE))
+                search = (query_params.get('q') or '').strip().lower()
+                after = None
+                if query_params.get('cursor'):
+                    after = decode_user_cursor(query_params['cursor'])
+                    if not after:
+                        return {
+                            'statusCode': 400,
+                            'headers': cors_headers,
+                            'body': json.dumps({'error': 'Некорректный курсор'}),
+                            'isBase64Encoded': False
+                        }
+                
+                # Порядок по lower(username) COLLATE "C" совпадает с индексом idx_users_username_lower_c:
+                # он обслуживает и префиксный LIKE, и keyset-курсор
+                conditions = ['id != %s']
+                params: List[Any] = [user_data['user_id']]
+                if search:
+                    escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                    if query_params.get('match') == 'contains':
+                        conditions.append("lower(username) LIKE %s")
+                        params.append(f'%{escaped}%')
+                    else:
+                        conditions.append('lower(username) COLLATE "C" LIKE %s')
+                        params.append(f'{escaped}%')
+                if after:
+                    conditions.append('(lower(username) COLLATE "C", id) > (%s, %s)')
+                    params.extend(after)
+                params.append(limit + 1)
+                
+                cur.execute(f'''
+                    SELECT id, username, avatar_url, is_admin, lower(username) AS sort_name
+                    FROM users
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY lower(username) COLLATE "C", id
+                    LIMIT %s
+                ''', tuple(params))
+                
+                users = [dict(row) for row in cur.fetchall()]
+                next_cursor = None
+                if len(users) > limit:
+                    users = users[:limit]
+                    next_cursor = encode_user_cursor(users[-1]['sort_name'], users[-1]['id'])
+                for user in users:
+                    del user['sort_name']
+                
                 return {
-                    'statusCode': 403,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Вы не друзья с этим пользователем'}),
+                    'body': json.dumps({'users': users, 'next_cursor': next_cursor}),
                     'isBase64Encoded': False
                 }
-            
-            now = datetime.now()
-            cur.execute('''
-                INSERT INTO private_messages (sender_id, recipient_id, message, created_at, is_read)
-                VALUES (%s, %s, %s, %s, FALSE)
-                RETURNING id, sender_id, recipient_id, message, created_at, is_read
-            ''', (user_data['user_id'], recipient_id, message, now))
-            
-            new_message = dict(cur.fetchone())
-            if new_message['created_at']:
-                new_message['created_at'] = new_message['created_at'].isoformat()
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'message': new_message, 'success': True}),
-                'isBase64Encoded': False
-            }
         
-        elif action == 'add_friend':
-            friend_id = body_data.get('friend_id', '').strip()
-            
-            if not friend_id:
-                conn.close()
+        elif method == 'POST':
+            body_data = json.loads(event.get('body', '{}'))
+            action = body_data.get('action', '')
+            
+            if action == 'send_message':
+                message = body_data.get('message', '').strip()
+                
+                if not message:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Сообщение не может быть пустым'}),
+                        'isBase64Encoded': False
+                    }
+                
+                if len(message) > 500:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Сообщение слишком длинное (макс. 500 символов)'}),
+                        'isBase64Encoded': False
+                    }
+                
+                user = get_author_profile(cur, user_data['user_id'])
+                if not user:
+                    return {
+                        'statusCode': 404,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Пользователь не найден'}),
+                        'isBase64Encoded': False
+                    }
+                
+                message_id = str(uuid.uuid4())
+                now = datetime.now()
+                
+                # Вставка и уведомление одним запросом; слушатели получат его только после commit
+                cur.execute('''
+                    WITH inserted AS (
+                        INSERT INTO chat_messages (id, user_id, username, avatar_url, message, created_at, is_active)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        RETURNING id, user_id, username, avatar_url, message, created_at
+                    )
+                    SELECT inserted.*, pg_notify(%s, inserted.id) AS notified
+                    FROM inserted
+                ''', (message_id, user['id'], user['username'], user['avatar_url'], message, now, True, PUBLIC_CHAT_CHANNEL))
+                
+                new_message = dict(cur.fetchone())
+                del new_message['notified']
+                if new_message['created_at']:
+                    new_message['created_at'] = new_message['created_at'].isoformat()
+                
+                conn.commit()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'friend_id обязателен'}),
+                    'body': json.dumps({'message': new_message, 'success': True}),
                     'isBase64Encoded': False
                 }
             
-            if friend_id == user_data['user_id']:
-                conn.close()
+            elif action == 'send_private_message':
+                recipient_id = body_data.get('recipient_id', '').strip()
+                message = body_data.get('message', '').strip()
+                
+                if not message or not recipient_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Сообщение и ID получателя обязательны'}),
+                        'isBase64Encoded': False
+                    }
+                
+                if len(message) > 500:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Сообщение слишком длинное'}),
+                        'isBase64Encoded': False
+                    }
+                
+                if recipient_id not in get_friend_ids(cur, user_data['user_id']):
+                    return {
+                        'statusCode': 403,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Вы не друзья с этим пользователем'}),
+                        'isBase64Encoded': False
+                    }
+                
+                now = datetime.now()
+                cur.execute('''
+                    INSERT INTO private_messages (sender_id, recipient_id, message, created_at, is_read)
+                    VALUES (%s, %s, %s, %s, FALSE)
+                    RETURNING id, sender_id, recipient_id, message, created_at, is_read
+                ''', (user_data['user_id'], recipient_id, message, now))
+                
+                new_message = dict(cur.fetchone())
+                if new_message['created_at']:
+                    new_message['created_at'] = new_message['created_at'].isoformat()
+                
+                update_conversations(cur, new_message)
+                
+                # Будим ожидающие запросы получателя и других вкладок отправителя
+                cur.execute('SELECT pg_notify(%s, %s), pg_notify(%s, %s)', (
+                    private_chat_channel(recipient_id), str(new_message['id']),
+                    private_chat_channel(user_data['user_id']), str(new_message['id'])
+                ))
+                conn.commit()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Нельзя добавить себя в друзья'}),
+                    'body': json.dumps({'message': new_message, 'success': True}),
                     'isBase64Encoded': False
                 }
             
-            cur.execute('''
-                SELECT COUNT(*) as cnt FROM friends
-                WHERE (user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s)
-            ''', (user_data['user_id'], friend_id, friend_id, user_data['user_id']))
-            
-            existing = cur.fetchone()
-            if existing['cnt'] > 0:
-                conn.close()
+            elif action == 'mark_read':
+                friend_id = str(body_data.get('friend_id', '')).strip()
+                up_to_id = body_data.get('up_to_id')
+                
+                if not friend_id or not isinstance(up_to_id, int) or up_to_id <= 0:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'friend_id и up_to_id обязательны'}),
+                        'isBase64Encoded': False
+                    }
+                
+                cur.execute(MARK_READ_QUERY, {'user_id': user_data['user_id'], 'friend_id': friend_id, 'up_to_id': up_to_id})
+                result = cur.fetchone()
+                conn.commit()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Заявка уже отправлена или вы уже друзья'}),
+                    'body': json.dumps({
+                        'success': True,
+                        'marked': result['marked'],
+                        'last_read_id': result['last_read_id'],
+                        'unread_count': result['unread_count']
+                    }),
                     'isBase64Encoded': False
                 }
             
-            now = datetime.now()
-            cur.execute('''
-                INSERT INTO friends (user_id, friend_id, status, created_at)
-                VALUES (%s, %s, 'pending', %s)
-            ''', (user_data['user_id'], friend_id, now))
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'success': True, 'message': 'Заявка отправлена'}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'accept_friend':
-            friend_id = body_data.get('friend_id', '').strip()
-            
-            if not friend_id:
-                conn.close()
+            elif action == 'add_friend':
+                friend_id = body_data.get('friend_id', '').strip()
+                
+                if not friend_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'friend_id обязателен'}),
+                        'isBase64Encoded': False
+                    }
+                
+                if friend_id == user_data['user_id']:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Нельзя добавить себя в друзья'}),
+                        'isBase64Encoded': False
+                    }
+                
+                cur.execute('''
+                    SELECT COUNT(*) as cnt FROM friends
+                    WHERE (user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s)
+                ''', (user_data['user_id'], friend_id, friend_id, user_data['user_id']))
+                
+                existing = cur.fetchone()
+                if existing['cnt'] > 0:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Заявка уже отправлена или вы уже друзья'}),
+                        'isBase64Encoded': False
+                    }
+                
+                now = datetime.now()
+                cur.execute('''
+                    INSERT INTO friends (user_id, friend_id, status, created_at)
+                    VALUES (%s, %s, 'pending', %s)
+                ''', (user_data['user_id'], friend_id, now))
+                
+                conn.commit()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'friend_id обязателен'}),
+                    'body': json.dumps({'success': True, 'message': 'Заявка отправлена'}),
                     'isBase64Encoded': False
                 }
             
-            cur.execute('''
-                UPDATE friends
-                SET status = 'accepted'
-                WHERE user_id = %s AND friend_id = %s AND status = 'pending'
-            ''', (friend_id, user_data['user_id']))
-            
-            if cur.rowcount == 0:
-                conn.close()
+            elif action == 'accept_friend':
+                friend_id = body_data.get('friend_id', '').strip()
+                
+                if not friend_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'friend_id обязателен'}),
+                        'isBase64Encoded': False
+                    }
+                
+                cur.execute('''
+                    UPDATE friends
+                    SET status = 'accepted'
+                    WHERE user_id = %s AND friend_id = %s AND status = 'pending'
+                ''', (friend_id, user_data['user_id']))
+                
+                if cur.rowcount == 0:
+                    return {
+                        'statusCode': 404,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Заявка не найдена'}),
+                        'isBase64Encoded': False
+                    }
+                
+                now = datetime.now()
+                cur.execute('''
+                    INSERT INTO friends (user_id, friend_id, status, created_at)
+                    VALUES (%s, %s, 'accepted', %s)
+                    ON CONFLICT (user_id, friend_id) DO UPDATE SET status = 'accepted'
+                ''', (user_data['user_id'], friend_id, now))
+                
+                invalidate_friends(cur, [user_data['user_id'], friend_id])
+                conn.commit()
+                
                 return {
-                    'statusCode': 404,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'Заявка не найдена'}),
+                    'body': json.dumps({'success': True, 'message': 'Заявка принята'}),
                     'isBase64Encoded': False
                 }
             
-            now = datetime.now()
-            cur.execute('''
-                INSERT INTO friends (user_id, friend_id, status, created_at)
-                VALUES (%s, %s, 'accepted', %s)
-                ON CONFLICT (user_id, friend_id) DO UPDATE SET status = 'accepted'
-            ''', (user_data['user_id'], friend_id, now))
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'success': True, 'message': 'Заявка принята'}),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'reject_friend':
-            friend_id = body_data.get('friend_id', '').strip()
-            
-            if not friend_id:
-                conn.close()
+            elif action == 'reject_friend':
+                friend_id = body_data.get('friend_id', '').strip()
+                
+                if not friend_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'friend_id обязателен'}),
+                        'isBase64Encoded': False
+                    }
+                
+                cur.execute('''
+                    UPDATE friends
+                    SET status = 'rejected'
+                    WHERE user_id = %s AND friend_id = %s AND status = 'pending'
+                ''', (friend_id, user_data['user_id']))
+                
+                # Отклоненная заявка не меняет список принятых друзей, общую версию не трогаем
+                invalidate_friends(cur, [user_data['user_id'], friend_id], bump_version=False)
+                conn.commit()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'friend_id обязателен'}),
+                    'body': json.dumps({'success': True, 'message': 'Заявка отклонена'}),
                     'isBase64Encoded': False
                 }
-            
-            cur.execute('''
-                UPDATE friends
-                SET status = 'rejected'
-                WHERE user_id = %s AND friend_id = %s AND status = 'pending'
-            ''', (friend_id, user_data['user_id']))
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'success': True, 'message': 'Заявка отклонена'}),
-                'isBase64Encoded': False
-            }
-    
-    elif method == 'DELETE':
-        query_params = event.get('queryStringParameters') or {}
-        action = query_params.get('action', '')
         
-        if action == 'remove_friend':
-            friend_id = query_params.get('friend_id', '').strip()
-            
-            if not friend_id:
-                conn.close()
+        elif method == 'DELETE':
+            query_params = event.get('queryStringParameters') or {}
+            action = query_params.get('action', '')
+            
+            if action == 'remove_friend':
+                friend_id = query_params.get('friend_id', '').strip()
+                
+                if not friend_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'friend_id обязателен'}),
+                        'isBase64Encoded': False
+                    }
+                
+                cur.execute('''
+                    UPDATE friends
+                    SET status = 'removed'
+                    WHERE (user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s)
+                ''', (user_data['user_id'], friend_id, friend_id, user_data['user_id']))
+                
+                invalidate_friends(cur, [user_data['user_id'], friend_id])
+                conn.commit()
+                
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': cors_headers,
-                    'body': json.dumps({'error': 'friend_id обязателен'}),
+                    'body': json.dumps({'success': True, 'message': 'Друг удален'}),
                     'isBase64Encoded': False
                 }
-            
-            cur.execute('''
-                UPDATE friends
-                SET status = 'removed'
-                WHERE (user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s)
-            ''', (user_data['user_id'], friend_id, friend_id, user_data['user_id']))
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': cors_headers,
-                'body': json.dumps({'success': True, 'message': 'Друг удален'}),
-                'isBase64Encoded': False
-            }
+        
+        return {
+            'statusCode': 400,
+            'headers': cors_headers,
+            'body': json.dumps({'error': 'Invalid request'}),
+            'isBase64Encoded': False
+        }
     
-    conn.close()
-    return {
-        'statusCode': 400,
-        'headers': cors_headers,
-        'body': json.dumps({'error': 'Invalid request'}),
-        'isBase64Encoded': False
-    }
+    finally:
+        cur.close()
+        release_db_connection(conn)
@@ -0,0 +1,22 @@
+# Копия backend/_shared/triggers.py, не редактировать: правьте оригинал и запустите python backend/_shared/sync.py
+'''
+Распознавание вызова функции триггером-таймером, а не HTTP-запросом.
+'''
+
+from typing import Any, Dict
+
+TIMER_EVENT_TYPE = 'yandex.cloud.events.serverless.triggers.TimerMessage'
+
+def is_timer_event(event: Dict[str, Any]) -> bool:
+    # Таймер присылает {"messages": [{"event_metadata": {"event_type": ...}, "details": {...}}]}
+    if 'httpMethod' in event:
+        return False
+    messages = event.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return False
+    return all(
+        isinstance(message, dict)
+        and isinstance(message.get('event_metadata'), dict)
+        and message['event_metadata'].get('event_type') == TIMER_EVENT_TYPE
+        for message in messages
+    )
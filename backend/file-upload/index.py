@@ -7,19 +7,24 @@ Returns: HTTP ответ с URL загруженного файла
 import json
 import os
 import base64
+import gzip
 import hashlib
 import secrets
 from datetime import datetime
-from typing import Dict, Any
-import psycopg2
+from typing import Dict, Any, Optional
+import brotli
 from psycopg2.extras import RealDictCursor
-
-DATABASE_URL = os.environ.get('DATABASE_URL')
+from db_pool import get_db_connection, release_db_connection
 
 ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/gif']
 ALLOWED_VIDEO_TYPES = ['video/mp4', 'video/webm', 'video/ogg']
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
 
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
@@ -35,7 +40,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {'statusCode': 200, 'headers': cors_headers, 'body': ''}
     
     try:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        conn = get_db_connection(RealDictCursor)
         
         if method == 'POST':
             return handle_upload(conn, event, cors_headers)
@@ -50,7 +55,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return error_response(f'Ошибка сервера: {str(e)}', 500, cors_headers)
     finally:
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
 
 def handle_upload(conn: Any, event: Dict, headers: Dict) -> Dict:
     auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
@@ -141,7 +146,7 @@ def handle_get_files(conn: Any, event: Dict, headers: Dict) -> Dict:
     
     files = [dict(row) for row in cur.fetchall()]
     
-    return success_response({'files': files}, headers)
+    return compress_response(event, success_response({'files': files}, headers))
 
 def handle_delete(conn: Any, event: Dict, headers: Dict) -> Dict:
     auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
@@ -187,6 +192,41 @@ def success_response(data: Dict, headers: Dict) -> Dict:
         'body': json.dumps(data, ensure_ascii=False)
     }
 
+def choose_encoding(event: Dict) -> Optional[str]:
+    request_headers = event.get('headers') or {}
+    accept_encoding = (request_headers.get('Accept-Encoding') or request_headers.get('accept-encoding') or '').lower()
+    accepted = set()
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip())
+    for encoding in ('br', 'gzip'):
+        if encoding in accepted:
+            return encoding
+    return None
+
+def compress_response(event: Dict, response: Dict) -> Dict:
+    body = response.get('body') or ''
+    if response['statusCode'] != 200 or len(body) < COMPRESSION_MIN_BYTES:
+        return response
+    encoding = choose_encoding(event)
+    if not encoding:
+        return response
+    
+    raw = body.encode('utf-8')
+    if encoding == 'br':
+        data = brotli.compress(raw, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(raw, compresslevel=GZIP_LEVEL)
+    
+    return {
+        **response,
+        'headers': {**response['headers'], 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+        'body': base64.b64encode(data).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
 def error_response(message: str, status: int, headers: Dict) -> Dict:
     return {
         'statusCode': status,
@@ -0,0 +1,84 @@
+# Копия backend/_shared/db_pool.py, не редактировать: правьте оригинал и запустите python backend/_shared/sync.py
+'''
+Пул соединений с Postgres, общий для всех функций backend.
+Пул живет в модуле между вызовами теплого контейнера.
+'''
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+import psycopg2
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '2'))
+DB_POOL_HEALTHCHECK_SECONDS = int(os.environ.get('DB_POOL_HEALTHCHECK_SECONDS', '30'))
+DB_POOL_LOG_EVERY = int(os.environ.get('DB_POOL_LOG_EVERY', '100'))
+
+_db_pool: List[Tuple[Any, float]] = []
+_db_pool_lock = threading.Lock()
+_db_pool_stats = {'hits': 0, 'misses': 0, 'discarded': 0}
+
+def get_db_connection(cursor_factory: Any = None):
+    while True:
+        with _db_pool_lock:
+            if not _db_pool:
+                break
+            conn, released_at = _db_pool.pop()
+        if is_connection_healthy(conn, time.monotonic() - released_at):
+            record_pool_event('hits')
+            return conn
+        record_pool_event('discarded')
+        close_db_connection(conn)
+    
+    record_pool_event('misses')
+    return psycopg2.connect(os.environ.get('DATABASE_URL'), cursor_factory=cursor_factory)
+
+def is_connection_healthy(conn: Any, idle_seconds: float) -> bool:
+    if conn.closed:
+        return False
+    if idle_seconds < DB_POOL_HEALTHCHECK_SECONDS:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_db_connection(conn: Any) -> None:
+    if conn.closed:
+        return
+    try:
+        # Сбрасываем состояние транзакции, чтобы следующий вызов получил чистое соединение
+        conn.rollback()
+        if conn.autocommit:
+            conn.autocommit = False
+    except psycopg2.Error:
+        record_pool_event('discarded')
+        close_db_connection(conn)
+        return
+    
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_MAX_SIZE:
+            _db_pool.append((conn, time.monotonic()))
+            return
+    close_db_connection(conn)
+
+def close_db_connection(conn: Any) -> None:
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def record_pool_event(kind: str) -> None:
+    with _db_pool_lock:
+        _db_pool_stats[kind] += 1
+        requests_served = _db_pool_stats['hits'] + _db_pool_stats['misses']
+    if kind != 'discarded' and DB_POOL_LOG_EVERY and requests_served % DB_POOL_LOG_EVERY == 0:
+        print(f'DB pool stats: {db_pool_stats()}')
+
+def db_pool_stats() -> Dict[str, int]:
+    with _db_pool_lock:
+        return {**_db_pool_stats, 'idle': len(_db_pool)}
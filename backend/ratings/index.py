@@ -1,7 +1,365 @@
 import json
 import os
+import time
+import threading
+from collections import OrderedDict
 import psycopg2
-from typing import Dict, Any
+from db_pool import get_db_connection, release_db_connection
+from triggers import is_timer_event
+from typing import Dict, Any, List, Optional, Tuple
+
+RATINGS_BATCH_MAX_IDS = int(os.environ.get('RATINGS_BATCH_MAX_IDS', '100'))
+# sync - средняя сразу пишется в anime; deferred - голоса копятся в anime_rating_dirty и сбрасываются пачкой
+RATING_PROPAGATION = os.environ.get('RATING_PROPAGATION', 'sync')
+RATING_FLUSH_INTERVAL_SECONDS = int(os.environ.get('RATING_FLUSH_INTERVAL_SECONDS', '30'))
+RATING_MAX_STALENESS_SECONDS = int(os.environ.get('RATING_MAX_STALENESS_SECONDS', '120'))
+RATING_FLUSH_BATCH_SIZE = int(os.environ.get('RATING_FLUSH_BATCH_SIZE', '500'))
+# Вес априорной средней в байесовском рейтинге: сколько "виртуальных" голосов со средней оценкой добавляется каждому аниме
+RATING_PRIOR_VOTES = int(os.environ.get('RATING_PRIOR_VOTES', '10'))
+RATING_PRIOR_REFRESH_SECONDS = int(os.environ.get('RATING_PRIOR_REFRESH_SECONDS', '3600'))
+LEADERBOARD_CACHE_TTL = int(os.environ.get('LEADERBOARD_CACHE_TTL', '60'))
+LEADERBOARD_CACHE_MAX_ENTRIES = int(os.environ.get('LEADERBOARD_CACHE_MAX_ENTRIES', '256'))
+LEADERBOARD_DEFAULT_LIMIT = 20
+LEADERBOARD_MAX_LIMIT = 100
+LEADERBOARD_MIN_VOTES = int(os.environ.get('LEADERBOARD_MIN_VOTES', '1'))
+TRENDING_DEFAULT_DAYS = 7
+TRENDING_MAX_DAYS = 30
+
+_last_rating_flush_at = 0.0
+_rating_flush_lock = threading.Lock()
+
+# Готовые тела ответов лидербордов: ключ -> (время сборки, JSON); жанр в ключе задает клиент, поэтому размер ограничен
+_leaderboard_cache: 'OrderedDict[Tuple[Any, ...], Tuple[float, str]]' = OrderedDict()
+_leaderboard_lock = threading.Lock()
+
+def fetch_rating_summary(cur, anime_id: Any) -> Tuple[float, int]:
+    cur.execute(
+        "SELECT ROUND(rating_sum::numeric / NULLIF(rating_count, 0), 1), rating_count FROM anime_rating_stats WHERE anime_id = %s",
+        (anime_id,)
+    )
+    row = cur.fetchone()
+    if not row:
+        return 0.0, 0
+    return (float(row[0]) if row[0] else 0.0), row[1]
+
+def parse_anime_ids(value: str) -> List[int]:
+    anime_ids: List[int] = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        anime_id = int(part)
+        if anime_id not in anime_ids:
+            anime_ids.append(anime_id)
+    return anime_ids
+
+def fetch_rating_summaries(cur, anime_ids: List[int]) -> Dict[int, Tuple[float, int]]:
+    cur.execute(
+        "SELECT anime_id, ROUND(rating_sum::numeric / NULLIF(rating_count, 0), 1), rating_count FROM anime_rating_stats WHERE anime_id = ANY(%s)",
+        (anime_ids,)
+    )
+    return {row[0]: ((float(row[1]) if row[1] else 0.0), row[2]) for row in cur.fetchall()}
+
+def fetch_user_ratings(cur, user_id: str, anime_ids: List[int]) -> Dict[int, int]:
+    cur.execute(
+        "SELECT anime_id, rating FROM ratings WHERE user_id = %s AND anime_id = ANY(%s)",
+        (user_id, anime_ids)
+    )
+    return {row[0]: row[1] for row in cur.fetchall()}
+
+# previous_rating фиксирует старую оценку под той же блокировкой строки, что и upsert,
+# поэтому смена оценки дает дельту, а не повторный учет голоса.
+VOTE_STATS_CTE = """
+    WITH vote AS (
+        INSERT INTO ratings (user_id, anime_id, rating)
+        VALUES (%(user_id)s, %(anime_id)s, %(rating)s)
+        ON CONFLICT (user_id, anime_id) DO UPDATE SET
+            previous_rating = ratings.rating,
+            rating = EXCLUDED.rating,
+            created_at = CURRENT_TIMESTAMP
+        RETURNING rating, CASE WHEN xmax = 0 THEN NULL ELSE previous_rating END AS old_rating
+    ),
+    stats AS (
+        INSERT INTO anime_rating_stats (anime_id, rating_sum, rating_count, histogram, bayesian_score)
+        SELECT
+            %(anime_id)s,
+            vote.rating - COALESCE(vote.old_rating, 0),
+            CASE WHEN vote.old_rating IS NULL THEN 1 ELSE 0 END,
+            ARRAY(
+                SELECT (CASE WHEN b = vote.rating THEN 1 ELSE 0 END) - (CASE WHEN b = vote.old_rating THEN 1 ELSE 0 END)
+                FROM generate_series(1, 10) AS b
+                ORDER BY b
+            ),
+            COALESCE((SELECT (g.prior_votes * g.prior_mean + vote.rating) / (g.prior_votes + 1) FROM rating_global_stats g WHERE g.id = 1), vote.rating)
+        FROM vote
+        ON CONFLICT (anime_id) DO UPDATE SET
+            rating_sum = anime_rating_stats.rating_sum + EXCLUDED.rating_sum,
+            rating_count = anime_rating_stats.rating_count + EXCLUDED.rating_count,
+            histogram = ARRAY(
+                SELECT h + d
+                FROM unnest(anime_rating_stats.histogram, EXCLUDED.histogram) WITH ORDINALITY AS t(h, d, i)
+                ORDER BY i
+            ),
+            bayesian_score = (
+                SELECT (g.prior_votes * g.prior_mean + anime_rating_stats.rating_sum + EXCLUDED.rating_sum)
+                       / NULLIF(g.prior_votes + anime_rating_stats.rating_count + EXCLUDED.rating_count, 0)
+                FROM rating_global_stats g
+                WHERE g.id = 1
+            ),
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING COALESCE(ROUND(rating_sum::numeric / NULLIF(rating_count, 0), 1), 0) AS average_rating, rating_count
+    ),
+    bucket AS (
+        -- Только первые голоса: смена оценки не добавляет голос, а ее разница не попадает в окно,
+        -- потому что исходный голос мог лежать в корзине за его пределами
+        INSERT INTO anime_vote_buckets (anime_id, bucket_date, votes, rating_sum)
+        SELECT %(anime_id)s, CURRENT_DATE, 1, vote.rating
+        FROM vote
+        WHERE vote.old_rating IS NULL
+        ON CONFLICT (anime_id, bucket_date) DO UPDATE SET
+            votes = anime_vote_buckets.votes + EXCLUDED.votes,
+            rating_sum = anime_vote_buckets.rating_sum + EXCLUDED.rating_sum
+        RETURNING anime_id
+    ),
+"""
+
+# Синхронный режим: рейтинг в anime и карточка каталога меняются вместе с голосом.
+# Версию кэша каталога голос не трогает: общая строка cache_versions сериализовала бы все голоса.
+# Функция anime замечает голос по anime_catalog_items.updated_at в отпечатке каталога.
+SYNC_PROPAGATION_CTE = """
+    anime_update AS (
+        UPDATE anime SET rating = stats.average_rating
+        FROM stats
+        WHERE anime.id = %(anime_id)s
+        RETURNING anime.id
+    ),
+    item_update AS (
+        UPDATE anime_catalog_items
+        SET item = jsonb_set(item, '{rating}', to_jsonb(stats.average_rating::float8)), updated_at = CURRENT_TIMESTAMP
+        FROM stats
+        WHERE anime_catalog_items.anime_id = %(anime_id)s
+        RETURNING anime_catalog_items.anime_id
+    )
+    SELECT average_rating, rating_count, NULL::float8 FROM stats
+"""
+
+# Отложенный режим: голос только помечает аниме грязным, LEAST сохраняет самую раннюю отметку.
+# DO UPDATE, а не DO NOTHING: если сброс уже держит отметку, голос ждет его commit и вставляет ее заново.
+# Иначе сброс записал бы среднюю из своего снимка без этого голоса и удалил отметку.
+DEFERRED_PROPAGATION_CTE = """
+    dirty AS (
+        INSERT INTO anime_rating_dirty (anime_id)
+        SELECT %(anime_id)s FROM stats
+        ON CONFLICT (anime_id) DO UPDATE SET dirtied_at = LEAST(anime_rating_dirty.dirtied_at, EXCLUDED.dirtied_at)
+        RETURNING anime_id
+    )
+    SELECT average_rating, rating_count,
+           (SELECT EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(dirtied_at))::float8 FROM anime_rating_dirty)
+    FROM stats
+"""
+
+def cast_vote(cur, user_id: str, anime_id: Any, rating: int) -> Tuple[float, int, Optional[float]]:
+    # Один оператор на голос; третий элемент - возраст самой старой грязной отметки в отложенном режиме
+    propagation = DEFERRED_PROPAGATION_CTE if RATING_PROPAGATION == 'deferred' else SYNC_PROPAGATION_CTE
+    cur.execute(
+        VOTE_STATS_CTE + propagation,
+        {'user_id': user_id, 'anime_id': anime_id, 'rating': rating}
+    )
+    row = cur.fetchone()
+    return float(row[0]), row[1], row[2]
+
+def flush_dirty_ratings(cur) -> int:
+    # SKIP LOCKED позволяет нескольким экземплярам сбрасывать очередь параллельно, не блокируя друг друга
+    cur.execute(
+        """
+        WITH dirty AS (
+            DELETE FROM anime_rating_dirty
+            WHERE anime_id IN (
+                SELECT anime_id FROM anime_rating_dirty
+                ORDER BY anime_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING anime_id
+        ),
+        averages AS (
+            SELECT dirty.anime_id,
+                   COALESCE(ROUND(s.rating_sum::numeric / NULLIF(s.rating_count, 0), 1), 0) AS average_rating
+            FROM dirty
+            LEFT JOIN anime_rating_stats s ON s.anime_id = dirty.anime_id
+        ),
+        anime_update AS (
+            UPDATE anime SET rating = averages.average_rating
+            FROM averages
+            WHERE anime.id = averages.anime_id AND anime.rating IS DISTINCT FROM averages.average_rating
+            RETURNING anime.id
+        ),
+        item_update AS (
+            UPDATE anime_catalog_items
+            SET item = jsonb_set(item, '{rating}', to_jsonb(averages.average_rating::float8)), updated_at = CURRENT_TIMESTAMP
+            FROM averages
+            WHERE anime_catalog_items.anime_id = averages.anime_id
+            RETURNING anime_catalog_items.anime_id
+        ),
+        version_bump AS (
+            UPDATE cache_versions
+            SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE cache_key = 'catalog' AND EXISTS (SELECT 1 FROM averages)
+            RETURNING version
+        )
+        SELECT COUNT(*) FROM averages
+        """,
+        (RATING_FLUSH_BATCH_SIZE,)
+    )
+    return cur.fetchone()[0]
+
+def rating_flush_due(oldest_dirty_age: Optional[float]) -> bool:
+    global _last_rating_flush_at
+    now = time.monotonic()
+    with _rating_flush_lock:
+        interval_elapsed = now - _last_rating_flush_at >= RATING_FLUSH_INTERVAL_SECONDS
+        too_stale = oldest_dirty_age is not None and oldest_dirty_age >= RATING_MAX_STALENESS_SECONDS
+        if not (interval_elapsed or too_stale):
+            return False
+        _last_rating_flush_at = now
+        return True
+
+def maybe_flush_dirty_ratings(conn: Any, cur, oldest_dirty_age: Optional[float]) -> None:
+    if not rating_flush_due(oldest_dirty_age):
+        return
+    try:
+        flushed = flush_dirty_ratings(cur)
+        conn.commit()
+        if flushed:
+            print(f'Flushed ratings for {flushed} anime')
+    except psycopg2.Error as e:
+        # Голос уже сохранен, очередь останется для следующего сброса
+        conn.rollback()
+        print(f'Rating flush failed: {e}')
+
+def flush_all_dirty_ratings(conn: Any, cur) -> int:
+    # Пачки по RATING_FLUSH_BATCH_SIZE, каждая в своей транзакции, пока очередь не опустеет
+    total = 0
+    while True:
+        flushed = flush_dirty_ratings(cur)
+        conn.commit()
+        total += flushed
+        if flushed < RATING_FLUSH_BATCH_SIZE:
+            return total
+
+def parse_limit(value: Optional[str], default: int, maximum: int) -> int:
+    try:
+        limit = int(value) if value else default
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
+
+def leaderboard_cache_key(query_params: Dict[str, Any]) -> Tuple[Any, ...]:
+    action = query_params.get('action')
+    limit = parse_limit(query_params.get('limit'), LEADERBOARD_DEFAULT_LIMIT, LEADERBOARD_MAX_LIMIT)
+    if action == 'trending':
+        return ('trending', parse_limit(query_params.get('days'), TRENDING_DEFAULT_DAYS, TRENDING_MAX_DAYS), limit)
+    return ('top', query_params.get('genre') or None, limit)
+
+def leaderboard_cache_get(key: Tuple[Any, ...]) -> Optional[str]:
+    with _leaderboard_lock:
+        entry = _leaderboard_cache.get(key)
+        if entry and time.monotonic() - entry[0] < LEADERBOARD_CACHE_TTL:
+            _leaderboard_cache.move_to_end(key)
+            return entry[1]
+        _leaderboard_cache.pop(key, None)
+        return None
+
+def leaderboard_cache_put(key: Tuple[Any, ...], body: str) -> None:
+    with _leaderboard_lock:
+        _leaderboard_cache[key] = (time.monotonic(), body)
+        _leaderboard_cache.move_to_end(key)
+        while len(_leaderboard_cache) > LEADERBOARD_CACHE_MAX_ENTRIES:
+            _leaderboard_cache.popitem(last=False)
+
+def refresh_rating_prior(cur) -> None:
+    # Пересчет априорной средней и всех байесовских оценок; WHERE по refreshed_at не дает экземплярам делать это одновременно
+    cur.execute(
+        """
+        WITH prior AS (
+            UPDATE rating_global_stats
+            SET prior_mean = COALESCE((SELECT SUM(rating_sum)::numeric / NULLIF(SUM(rating_count), 0) FROM anime_rating_stats), 0),
+                prior_votes = %s,
+                refreshed_at = CURRENT_TIMESTAMP
+            WHERE id = 1 AND refreshed_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            RETURNING prior_mean, prior_votes
+        ),
+        scores AS (
+            UPDATE anime_rating_stats s
+            SET bayesian_score = (prior.prior_votes * prior.prior_mean + s.rating_sum) / NULLIF(prior.prior_votes + s.rating_count, 0)
+            FROM prior
+            WHERE s.rating_count > 0
+              AND s.bayesian_score IS DISTINCT FROM ((prior.prior_votes * prior.prior_mean + s.rating_sum) / NULLIF(prior.prior_votes + s.rating_count, 0))::numeric(6,3)
+            RETURNING s.anime_id
+        )
+        DELETE FROM anime_vote_buckets
+        WHERE bucket_date < CURRENT_DATE - %s AND EXISTS (SELECT 1 FROM prior)
+        """,
+        (RATING_PRIOR_VOTES, RATING_PRIOR_REFRESH_SECONDS, TRENDING_MAX_DAYS)
+    )
+
+def fetch_top_rated(cur, genre: Optional[str], limit: int) -> List[Dict[str, Any]]:
+    genre_clause = "AND c.genres @> ARRAY[%s]::text[]" if genre else ""
+    params: List[Any] = [LEADERBOARD_MIN_VOTES] + ([genre] if genre else []) + [limit]
+    cur.execute(
+        f"""
+        SELECT c.item, s.bayesian_score, ROUND(s.rating_sum::numeric / NULLIF(s.rating_count, 0), 1), s.rating_count
+        FROM anime_rating_stats s
+        JOIN anime_catalog_items c ON c.anime_id = s.anime_id
+        WHERE s.rating_count >= %s {genre_clause}
+        ORDER BY s.bayesian_score DESC, s.anime_id
+        LIMIT %s
+        """,
+        params
+    )
+    return [
+        {
+            **row[0],
+            'score': float(row[1]),
+            'average_rating': float(row[2]) if row[2] else 0.0,
+            'total_ratings': row[3]
+        }
+        for row in cur.fetchall()
+    ]
+
+def fetch_trending(cur, days: int, limit: int) -> List[Dict[str, Any]]:
+    cur.execute(
+        """
+        SELECT c.item, t.votes, ROUND(t.rating_sum::numeric / NULLIF(t.votes, 0), 1)
+        FROM (
+            SELECT anime_id, SUM(votes) AS votes, SUM(rating_sum) AS rating_sum
+            FROM anime_vote_buckets
+            WHERE bucket_date > CURRENT_DATE - %s
+            GROUP BY anime_id
+            HAVING SUM(votes) > 0
+            ORDER BY SUM(votes) DESC, anime_id
+            LIMIT %s
+        ) t
+        JOIN anime_catalog_items c ON c.anime_id = t.anime_id
+        ORDER BY t.votes DESC, t.anime_id
+        """,
+        (days, limit)
+    )
+    return [
+        {
+            **row[0],
+            'recent_votes': int(row[1]),
+            'recent_average_rating': float(row[2]) if row[2] else 0.0
+        }
+        for row in cur.fetchall()
+    ]
+
+def build_leaderboard(cur, key: Tuple[Any, ...]) -> str:
+    if key[0] == 'trending':
+        _, days, limit = key
+        return json.dumps({'action': 'trending', 'days': days, 'items': fetch_trending(cur, days, limit)}, ensure_ascii=False)
+    _, genre, limit = key
+    return json.dumps({'action': 'top', 'genre': genre, 'items': fetch_top_rated(cur, genre, limit)}, ensure_ascii=False)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -12,6 +370,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     method: str = event.get('httpMethod', 'GET')
     
+    if 'httpMethod' not in event:
+        # Вызов по таймеру: очередь сбрасывается, даже если за аниме давно не голосовали и его не читали
+        if not is_timer_event(event):
+            return {'statusCode': 400, 'body': json.dumps({'error': 'Unsupported event'})}
+        if not os.environ.get('DATABASE_URL'):
+            return {'statusCode': 500, 'body': json.dumps({'error': 'Database not configured'})}
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            flushed = flush_all_dirty_ratings(conn, cur)
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        if flushed:
+            print(f'Flushed ratings for {flushed} anime')
+        return {'statusCode': 200, 'body': json.dumps({'flushed': flushed})}
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
@@ -32,31 +407,88 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Database not configured'})
         }
     
-    conn = psycopg2.connect(database_url)
+    query_params = event.get('queryStringParameters') or {}
+    leaderboard_key = None
+    if method == 'GET' and query_params.get('action') in ('top', 'trending'):
+        # Лидерборды отдаются из кэша экземпляра без обращения к базе
+        leaderboard_key = leaderboard_cache_key(query_params)
+        cached_body = leaderboard_cache_get(leaderboard_key)
+        if cached_body is not None:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': cached_body
+            }
+    
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
+        if method == 'GET' and RATING_PROPAGATION == 'deferred':
+            # Чтения тоже сбрасывают очередь, иначе последний голос за аниме ждал бы следующего голоса
+            maybe_flush_dirty_ratings(conn, cur, None)
+        
+        if method == 'GET' and leaderboard_key is not None:
+            refresh_rating_prior(cur)
+            conn.commit()
+            body = build_leaderboard(cur, leaderboard_key)
+            leaderboard_cache_put(leaderboard_key, body)
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': body
+            }
+        
         if method == 'GET':
-            query_params = event.get('queryStringParameters') or {}
             anime_id = query_params.get('anime_id')
+            headers = event.get('headers', {})
+            user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+            
+            if query_params.get('anime_ids') is not None:
+                # Пакетный режим: одна выборка агрегатов и одна выборка оценок пользователя на всю страницу
+                try:
+                    anime_ids = parse_anime_ids(query_params['anime_ids'])
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'anime_ids must be a comma-separated list of integers'})
+                    }
+                
+                if not anime_ids or len(anime_ids) > RATINGS_BATCH_MAX_IDS:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'anime_ids must contain between 1 and {RATINGS_BATCH_MAX_IDS} ids'})
+                    }
+                
+                summaries = fetch_rating_summaries(cur, anime_ids)
+                user_ratings = fetch_user_ratings(cur, user_id, anime_ids) if user_id else {}
+                
+                ratings = {}
+                for batch_id in anime_ids:
+                    avg_rating, total_ratings = summaries.get(batch_id, (0.0, 0))
+                    ratings[str(batch_id)] = {
+                        'average_rating': avg_rating,
+                        'total_ratings': total_ratings,
+                        'user_rating': user_ratings.get(batch_id)
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'ratings': ratings})
+                }
             
             if not anime_id:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'anime_id is required'})
+                    'body': json.dumps({'error': 'anime_id or anime_ids is required'})
                 }
             
-            cur.execute(
-                "SELECT AVG(rating)::numeric(3,1), COUNT(*) FROM ratings WHERE anime_id = %s",
-                (anime_id,)
-            )
-            row = cur.fetchone()
-            avg_rating = float(row[0]) if row[0] else 0.0
-            total_ratings = row[1]
+            avg_rating, total_ratings = fetch_rating_summary(cur, anime_id)
             
-            headers = event.get('headers', {})
-            user_id = headers.get('X-User-Id') or headers.get('x-user-id')
             user_rating = None
             
             if user_id:
@@ -100,32 +532,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'anime_id and rating are required'})
                 }
             
-            if rating < 1 or rating > 10:
+            if not isinstance(rating, int) or rating < 1 or rating > 10:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'rating must be between 1 and 10'})
+                    'body': json.dumps({'error': 'rating must be an integer between 1 and 10'})
                 }
             
-            cur.execute(
-                "INSERT INTO ratings (user_id, anime_id, rating) VALUES (%s, %s, %s) ON CONFLICT (user_id, anime_id) DO UPDATE SET rating = %s, created_at = CURRENT_TIMESTAMP",
-                (user_id, anime_id, rating, rating)
-            )
+            avg_rating, total_ratings, oldest_dirty_age = cast_vote(cur, user_id, anime_id, rating)
             conn.commit()
             
-            cur.execute(
-                "SELECT AVG(rating)::numeric(3,1), COUNT(*) FROM ratings WHERE anime_id = %s",
-                (anime_id,)
-            )
-            row = cur.fetchone()
-            avg_rating = float(row[0]) if row[0] else 0.0
-            total_ratings = row[1]
-            
-            cur.execute(
-                "UPDATE anime SET rating = %s WHERE id = %s",
-                (avg_rating, anime_id)
-            )
-            conn.commit()
+            if RATING_PROPAGATION == 'deferred':
+                maybe_flush_dirty_ratings(conn, cur, oldest_dirty_age)
             
             return {
                 'statusCode': 200,
@@ -145,4 +563,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
@@ -0,0 +1,225 @@
+'''
+Нагрузочный прогон функции ratings: handler вызывается напрямую из потоков или процессов
+против локального Postgres, как если бы тысячи пользователей голосовали одновременно.
+
+Запуск:
+    DATABASE_URL=postgres://... python benchmarks/ratings_load.py --anime-ids 1,2,3 \
+        --scenario hot --scenario uniform --workers 64 --votes 50 --output results.json
+
+Сценарии:
+    hot     - все голоса за первое аниме из --anime-ids (новая серия, на которую голосуют все сразу)
+    uniform - аниме выбирается равномерно из --anime-ids
+
+Для каждого сценария выводится пропускная способность, p50/p95/p99, ожидания блокировок
+(выборка pg_stat_activity) и дедлоки (прирост pg_stat_database.deadlocks).
+С --baseline результаты сравниваются с предыдущим JSON-файлом.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'ratings'))
+import db_pool  # noqa: E402
+import index as ratings  # noqa: E402
+from ratings_write_bench import BENCH_USER_PREFIX, cleanup  # noqa: E402
+
+LOCK_SAMPLE_INTERVAL_SECONDS = 0.05
+
+def run_worker(worker_id: int, scenario: str, anime_ids: List[int], votes: int, propagation: str) -> Dict[str, Any]:
+    ratings.RATING_PROPAGATION = propagation
+    rnd = random.Random(worker_id)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors: Dict[str, int] = {}
+
+    for i in range(votes):
+        anime_id = anime_ids[0] if scenario == 'hot' else rnd.choice(anime_ids)
+        event = {
+            'httpMethod': 'POST',
+            'headers': {'X-User-Id': f'{BENCH_USER_PREFIX}{worker_id}-{i}'},
+            'body': json.dumps({'anime_id': anime_id, 'rating': rnd.randint(1, 10)})
+        }
+        started = time.perf_counter()
+        try:
+            response = ratings.handler(event, None)
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        status = str(response['statusCode'])
+        statuses[status] = statuses.get(status, 0) + 1
+
+    return {'latencies': latencies, 'statuses': statuses, 'errors': errors}
+
+class LockSampler(threading.Thread):
+    def __init__(self, dsn: str):
+        super().__init__(daemon=True)
+        self.dsn = dsn
+        self.stop_event = threading.Event()
+        self.samples = 0
+        self.samples_with_waits = 0
+        self.max_waiters = 0
+        self.total_waiters = 0
+
+    def run(self) -> None:
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            while not self.stop_event.is_set():
+                cur.execute(
+                    "SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database() AND wait_event_type = 'Lock'"
+                )
+                waiters = cur.fetchone()[0]
+                self.samples += 1
+                self.total_waiters += waiters
+                self.max_waiters = max(self.max_waiters, waiters)
+                if waiters:
+                    self.samples_with_waits += 1
+                self.stop_event.wait(LOCK_SAMPLE_INTERVAL_SECONDS)
+        finally:
+            cur.close()
+            conn.close()
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'samples': self.samples,
+            'share_with_waits': round(self.samples_with_waits / self.samples, 3) if self.samples else 0.0,
+            'avg_waiters': round(self.total_waiters / self.samples, 2) if self.samples else 0.0,
+            'max_waiters': self.max_waiters,
+        }
+
+def read_deadlocks(dsn: str) -> int:
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()")
+    deadlocks = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return deadlocks
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))] * 1000, 2)
+
+def run_scenario(dsn: str, scenario: str, anime_ids: List[int], workers: int, votes: int,
+                 use_processes: bool, propagation: str) -> Dict[str, Any]:
+    cleanup(dsn, anime_ids)
+    deadlocks_before = read_deadlocks(dsn)
+    sampler = LockSampler(dsn)
+    sampler.start()
+
+    executor: Executor = ProcessPoolExecutor(max_workers=workers) if use_processes else ThreadPoolExecutor(max_workers=workers)
+    started = time.perf_counter()
+    with executor:
+        futures = [executor.submit(run_worker, i, scenario, anime_ids, votes, propagation) for i in range(workers)]
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - started
+
+    sampler.stop_event.set()
+    sampler.join()
+    deadlocks = read_deadlocks(dsn) - deadlocks_before
+
+    latencies = sorted(latency for r in results for latency in r['latencies'])
+    statuses: Dict[str, int] = {}
+    errors: Dict[str, int] = {}
+    for r in results:
+        for key, count in r['statuses'].items():
+            statuses[key] = statuses.get(key, 0) + count
+        for key, count in r['errors'].items():
+            errors[key] = errors.get(key, 0) + count
+
+    return {
+        'scenario': scenario,
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'statuses': statuses,
+        'errors': errors,
+        'lock_waits': sampler.summary(),
+        'deadlocks': deadlocks,
+    }
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = {r['scenario']: r for r in json.load(f)['results']}
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        if not previous:
+            continue
+        deltas = []
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'deadlocks'):
+            before, after = previous[metric], result[metric]
+            change = f'{(after - before) / before * 100:+.1f}%' if before else f'{after - before:+}'
+            deltas.append(f'{metric} {before} -> {after} ({change})')
+        print(f"{result['scenario']:>8} vs baseline: " + ', '.join(deltas))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Ratings handler concurrency load test')
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--anime-ids', required=True, help='comma-separated anime ids; the first one is the hot key')
+    parser.add_argument('--scenario', action='append', choices=['hot', 'uniform'], help='repeatable, defaults to both')
+    parser.add_argument('--workers', type=int, default=32, help='concurrent threads or processes')
+    parser.add_argument('--votes', type=int, default=50, help='votes per worker')
+    parser.add_argument('--processes', action='store_true', help='use processes instead of threads')
+    parser.add_argument('--propagation', choices=['sync', 'deferred'], default=ratings.RATING_PROPAGATION)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--baseline', help='previous JSON results to compare against')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+
+    # handler читает DATABASE_URL сам, пул должен вмещать все потоки, иначе замеряется переподключение
+    os.environ['DATABASE_URL'] = args.dsn
+    db_pool.DB_POOL_MAX_SIZE = max(db_pool.DB_POOL_MAX_SIZE, args.workers)
+    db_pool.DB_POOL_LOG_EVERY = 0
+
+    anime_ids = [int(part) for part in args.anime_ids.split(',') if part.strip()]
+    scenarios = args.scenario or ['hot', 'uniform']
+    results: List[Dict[str, Any]] = []
+    started_at = datetime.now(timezone.utc).isoformat()
+
+    try:
+        for scenario in scenarios:
+            result = run_scenario(args.dsn, scenario, anime_ids, args.workers, args.votes, args.processes, args.propagation)
+            results.append(result)
+            print(f"{scenario:>8}: {result['requests']} req in {result['seconds']}s, {result['throughput_rps']} req/s, "
+                  f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms p99={result['p99_ms']}ms, "
+                  f"lock waits={result['lock_waits']}, deadlocks={result['deadlocks']}, errors={result['errors']}")
+    finally:
+        cleanup(args.dsn, anime_ids)
+
+    report: Dict[str, Any] = {
+        'started_at': started_at,
+        'config': {
+            'anime_ids': anime_ids,
+            'workers': args.workers,
+            'votes_per_worker': args.votes,
+            'executor': 'process' if args.processes else 'thread',
+            'propagation': args.propagation,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+Нагрузочный тест записи оценок: старый поток (upsert, commit, AVG, UPDATE anime и каталога, commit)
+против одного оператора cast_vote из backend/ratings в режимах sync и deferred.
+
+Запуск:
+    DATABASE_URL=postgres://... python benchmarks/ratings_write_bench.py --anime-ids 1,2 --threads 16 --votes 200
+
+Ни один режим не обновляет общую строку cache_versions, поэтому голоса за разные аниме
+не ждут друг друга; в sync конкурируют только голоса за одно аниме (строки статистики и anime),
+в deferred - только за строку статистики.
+
+Голоса пишутся от пользователей bench-user-*, после прогона они удаляются,
+а агрегаты затронутых аниме пересчитываются из таблицы ratings.
+'''
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'ratings'))
+import index as ratings  # noqa: E402
+
+BENCH_USER_PREFIX = 'bench-user-'
+
+def legacy_vote(conn: Any, user_id: str, anime_id: int, rating: int) -> None:
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO ratings (user_id, anime_id, rating) VALUES (%s, %s, %s) ON CONFLICT (user_id, anime_id) DO UPDATE SET rating = %s, created_at = CURRENT_TIMESTAMP",
+        (user_id, anime_id, rating, rating)
+    )
+    conn.commit()
+    cur.execute(
+        "SELECT AVG(rating)::numeric(3,1), COUNT(*) FROM ratings WHERE anime_id = %s",
+        (anime_id,)
+    )
+    row = cur.fetchone()
+    avg_rating = float(row[0]) if row[0] else 0.0
+    cur.execute("UPDATE anime SET rating = %s WHERE id = %s", (avg_rating, anime_id))
+    cur.execute(
+        "UPDATE anime_catalog_items SET item = jsonb_set(item, '{rating}', to_jsonb(%s::float8)), updated_at = CURRENT_TIMESTAMP WHERE anime_id = %s",
+        (avg_rating, anime_id)
+    )
+    conn.commit()
+    cur.close()
+
+def single_statement_vote(conn: Any, user_id: str, anime_id: int, rating: int) -> None:
+    cur = conn.cursor()
+    _, _, oldest_dirty_age = ratings.cast_vote(cur, user_id, anime_id, rating)
+    conn.commit()
+    if ratings.RATING_PROPAGATION == 'deferred':
+        ratings.maybe_flush_dirty_ratings(conn, cur, oldest_dirty_age)
+    cur.close()
+
+def run_mode(dsn: str, vote: Callable[[Any, str, int, int], None], anime_ids: List[int],
+             threads: int, votes_per_thread: int, users: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def worker(seed: int) -> None:
+        rnd = random.Random(seed)
+        conn = psycopg2.connect(dsn)
+        local: List[float] = []
+        try:
+            for _ in range(votes_per_thread):
+                user_id = f'{BENCH_USER_PREFIX}{rnd.randrange(users)}'
+                started = time.perf_counter()
+                try:
+                    vote(conn, user_id, rnd.choice(anime_ids), rnd.randint(1, 10))
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    with lock:
+                        errors.append(type(e).__name__)
+                    continue
+                local.append(time.perf_counter() - started)
+        finally:
+            conn.close()
+        with lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    def pct(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+
+    return {
+        'votes': len(latencies),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'votes_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(pct(0.50), 2),
+        'p95_ms': round(pct(0.95), 2),
+        'p99_ms': round(pct(0.99), 2),
+    }
+
+def cleanup(dsn: str, anime_ids: List[int]) -> None:
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM ratings WHERE user_id LIKE %s", (BENCH_USER_PREFIX + '%',))
+    cur.execute("DELETE FROM anime_rating_dirty WHERE anime_id = ANY(%s)", (anime_ids,))
+    cur.execute("DELETE FROM anime_rating_stats WHERE anime_id = ANY(%s)", (anime_ids,))
+    cur.execute(
+        """
+        INSERT INTO anime_rating_stats (anime_id, rating_sum, rating_count, bayesian_score, histogram)
+        SELECT anime_id, SUM(rating), COUNT(*),
+               (SELECT (g.prior_votes * g.prior_mean + SUM(rating)) / (g.prior_votes + COUNT(*)) FROM rating_global_stats g WHERE g.id = 1),
+               ARRAY[
+                   COUNT(*) FILTER (WHERE rating = 1), COUNT(*) FILTER (WHERE rating = 2),
+                   COUNT(*) FILTER (WHERE rating = 3), COUNT(*) FILTER (WHERE rating = 4),
+                   COUNT(*) FILTER (WHERE rating = 5), COUNT(*) FILTER (WHERE rating = 6),
+                   COUNT(*) FILTER (WHERE rating = 7), COUNT(*) FILTER (WHERE rating = 8),
+                   COUNT(*) FILTER (WHERE rating = 9), COUNT(*) FILTER (WHERE rating = 10)
+               ]::INTEGER[]
+        FROM ratings
+        WHERE anime_id = ANY(%s)
+        GROUP BY anime_id
+        """,
+        (anime_ids,)
+    )
+    cur.execute("DELETE FROM anime_vote_buckets WHERE anime_id = ANY(%s) AND bucket_date = CURRENT_DATE", (anime_ids,))
+    cur.execute(
+        """
+        INSERT INTO anime_vote_buckets (anime_id, bucket_date, votes, rating_sum)
+        SELECT anime_id, CURRENT_DATE, COUNT(*), SUM(rating)
+        FROM ratings
+        WHERE anime_id = ANY(%s) AND created_at >= CURRENT_DATE AND previous_rating IS NULL
+        GROUP BY anime_id
+        """,
+        (anime_ids,)
+    )
+    cur.execute(
+        """
+        UPDATE anime SET rating = COALESCE((
+            SELECT ROUND(rating_sum::numeric / NULLIF(rating_count, 0), 1)
+            FROM anime_rating_stats WHERE anime_rating_stats.anime_id = anime.id
+        ), 0)
+        WHERE id = ANY(%s)
+        """,
+        (anime_ids,)
+    )
+    cur.execute(
+        """
+        UPDATE anime_catalog_items
+        SET item = jsonb_set(item, '{rating}', to_jsonb(anime.rating::float8)), updated_at = CURRENT_TIMESTAMP
+        FROM anime
+        WHERE anime.id = anime_catalog_items.anime_id AND anime.id = ANY(%s)
+        """,
+        (anime_ids,)
+    )
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Rating write throughput benchmark')
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--anime-ids', required=True, help='comma-separated anime ids to vote on')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--votes', type=int, default=200, help='votes per thread')
+    parser.add_argument('--users', type=int, default=1000, help='distinct synthetic voters')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+
+    anime_ids = [int(part) for part in args.anime_ids.split(',') if part.strip()]
+    modes = [
+        ('legacy', legacy_vote, 'sync'),
+        ('single_statement', single_statement_vote, 'sync'),
+        ('deferred', single_statement_vote, 'deferred'),
+    ]
+
+    try:
+        for name, vote, propagation in modes:
+            ratings.RATING_PROPAGATION = propagation
+            cleanup(args.dsn, anime_ids)
+            result = run_mode(args.dsn, vote, anime_ids, args.threads, args.votes, args.users)
+            print(f'{name:>16}: ' + ', '.join(f'{k}={v}' for k, v in result.items()))
+    finally:
+        cleanup(args.dsn, anime_ids)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+-- Индекс для постраничной выдачи каталога по ключу (release_year, id)
+CREATE INDEX IF NOT EXISTS idx_anime_catalog_order ON anime ((COALESCE(release_year, 0)) DESC, id DESC);
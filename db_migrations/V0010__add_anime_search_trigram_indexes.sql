@@ -0,0 +1,5 @@
+-- Триграммный поиск по названию и описанию аниме
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_anime_title_trgm ON anime USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_anime_description_trgm ON anime USING gin (description gin_trgm_ops);
@@ -0,0 +1,9 @@
+-- Счетчики версий для сброса кэшей теплых экземпляров функций
+CREATE TABLE IF NOT EXISTS cache_versions (
+    cache_key VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO cache_versions (cache_key, version) VALUES ('catalog', 0)
+ON CONFLICT (cache_key) DO NOTHING;
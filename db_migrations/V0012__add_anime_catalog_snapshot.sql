@@ -0,0 +1,34 @@
+-- Колонки, которые функция anime использует, но которые раньше добавлялись вне миграций
+ALTER TABLE anime ADD COLUMN IF NOT EXISTS is_movie BOOLEAN DEFAULT FALSE;
+ALTER TABLE anime ADD COLUMN IF NOT EXISTS duration_minutes INTEGER;
+
+-- Предсериализованные карточки публичного каталога
+CREATE TABLE IF NOT EXISTS anime_catalog_items (
+    anime_id INTEGER PRIMARY KEY REFERENCES anime(id),
+    is_movie BOOLEAN NOT NULL DEFAULT FALSE,
+    sort_year INTEGER NOT NULL DEFAULT 0,
+    item JSONB NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_anime_catalog_items_order ON anime_catalog_items(sort_year DESC, anime_id DESC);
+CREATE INDEX IF NOT EXISTS idx_anime_catalog_items_type_order ON anime_catalog_items(is_movie, sort_year DESC, anime_id DESC);
+
+-- Первичное заполнение из текущего каталога
+INSERT INTO anime_catalog_items (anime_id, is_movie, sort_year, item)
+SELECT a.id, COALESCE(a.is_movie, FALSE), COALESCE(a.release_year, 0),
+       jsonb_build_object(
+           'id', a.id::text,
+           'title', a.title,
+           'image', a.image_url,
+           'episodes', a.episodes,
+           'rating', COALESCE(a.rating, 0)::float8,
+           'description', a.description,
+           'genres', COALESCE(to_jsonb(a.genres), '[]'::jsonb),
+           'releaseYear', a.release_year,
+           'status', a.status,
+           'isMovie', COALESCE(a.is_movie, FALSE),
+           'duration', a.duration_minutes
+       )
+FROM anime a
+ON CONFLICT (anime_id) DO NOTHING;
@@ -0,0 +1,11 @@
+-- Жанры и статус в снимке каталога для фильтрации и подсчета фасетов
+ALTER TABLE anime_catalog_items ADD COLUMN IF NOT EXISTS genres TEXT[] NOT NULL DEFAULT '{}';
+ALTER TABLE anime_catalog_items ADD COLUMN IF NOT EXISTS status VARCHAR(50);
+
+UPDATE anime_catalog_items i
+SET genres = COALESCE(a.genres, ARRAY[]::text[]), status = a.status
+FROM anime a
+WHERE a.id = i.anime_id;
+
+CREATE INDEX IF NOT EXISTS idx_anime_catalog_items_genres ON anime_catalog_items USING gin (genres);
+CREATE INDEX IF NOT EXISTS idx_anime_genres ON anime USING gin (genres);
@@ -0,0 +1,31 @@
+-- Инкрементальные агрегаты оценок: сумма, количество и гистограмма 1..10 на каждое аниме
+ALTER TABLE ratings ADD COLUMN IF NOT EXISTS previous_rating INTEGER;
+
+CREATE TABLE IF NOT EXISTS anime_rating_stats (
+    anime_id INTEGER PRIMARY KEY,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    rating_count INTEGER NOT NULL DEFAULT 0,
+    histogram INTEGER[] NOT NULL DEFAULT '{0,0,0,0,0,0,0,0,0,0}',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO anime_rating_stats (anime_id, rating_sum, rating_count, histogram)
+SELECT
+    anime_id,
+    SUM(rating),
+    COUNT(*),
+    ARRAY[
+        COUNT(*) FILTER (WHERE rating = 1),
+        COUNT(*) FILTER (WHERE rating = 2),
+        COUNT(*) FILTER (WHERE rating = 3),
+        COUNT(*) FILTER (WHERE rating = 4),
+        COUNT(*) FILTER (WHERE rating = 5),
+        COUNT(*) FILTER (WHERE rating = 6),
+        COUNT(*) FILTER (WHERE rating = 7),
+        COUNT(*) FILTER (WHERE rating = 8),
+        COUNT(*) FILTER (WHERE rating = 9),
+        COUNT(*) FILTER (WHERE rating = 10)
+    ]::INTEGER[]
+FROM ratings
+GROUP BY anime_id
+ON CONFLICT (anime_id) DO NOTHING;
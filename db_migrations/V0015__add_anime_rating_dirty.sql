@@ -0,0 +1,7 @@
+-- Очередь аниме, чья средняя оценка еще не перенесена в anime.rating (режим RATING_PROPAGATION=deferred)
+CREATE TABLE IF NOT EXISTS anime_rating_dirty (
+    anime_id INTEGER PRIMARY KEY,
+    dirtied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_anime_rating_dirty_dirtied_at ON anime_rating_dirty (dirtied_at);
@@ -0,0 +1,40 @@
+-- Априорная средняя для байесовского рейтинга; пересчитывается периодически, а не на каждый голос
+CREATE TABLE IF NOT EXISTS rating_global_stats (
+    id SMALLINT PRIMARY KEY CHECK (id = 1),
+    prior_mean NUMERIC(6,3) NOT NULL DEFAULT 0,
+    prior_votes INTEGER NOT NULL DEFAULT 10,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO rating_global_stats (id, prior_mean, prior_votes)
+SELECT 1, COALESCE(SUM(rating_sum)::numeric / NULLIF(SUM(rating_count), 0), 0), 10
+FROM anime_rating_stats
+ON CONFLICT (id) DO NOTHING;
+
+-- Байесовская оценка хранится рядом с агрегатом и обновляется тем же оператором, что и голос
+ALTER TABLE anime_rating_stats ADD COLUMN IF NOT EXISTS bayesian_score NUMERIC(6,3) NOT NULL DEFAULT 0;
+
+UPDATE anime_rating_stats s
+SET bayesian_score = (g.prior_votes * g.prior_mean + s.rating_sum) / NULLIF(g.prior_votes + s.rating_count, 0)
+FROM rating_global_stats g
+WHERE g.id = 1;
+
+CREATE INDEX IF NOT EXISTS idx_anime_rating_stats_bayesian ON anime_rating_stats (bayesian_score DESC, anime_id);
+
+-- Дневные корзины голосов для трендов за последние дни
+CREATE TABLE IF NOT EXISTS anime_vote_buckets (
+    anime_id INTEGER NOT NULL,
+    bucket_date DATE NOT NULL,
+    votes INTEGER NOT NULL DEFAULT 0,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (anime_id, bucket_date)
+);
+
+CREATE INDEX IF NOT EXISTS idx_anime_vote_buckets_date ON anime_vote_buckets (bucket_date, anime_id);
+
+INSERT INTO anime_vote_buckets (anime_id, bucket_date, votes, rating_sum)
+SELECT anime_id, created_at::date, COUNT(*), SUM(rating)
+FROM ratings
+WHERE created_at >= CURRENT_DATE - 30
+GROUP BY anime_id, created_at::date
+ON CONFLICT (anime_id, bucket_date) DO NOTHING;
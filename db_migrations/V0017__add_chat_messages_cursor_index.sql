@@ -0,0 +1,2 @@
+-- Индекс под курсоры общего чата: последние сообщения, новее after_id/since и старее before
+CREATE INDEX IF NOT EXISTS idx_chat_messages_active_created ON chat_messages (is_active, created_at, id);
@@ -0,0 +1,28 @@
+-- Сводка диалогов: по строке на каждого участника пары с последним сообщением и счетчиком непрочитанных
+CREATE TABLE IF NOT EXISTS private_conversations (
+    user_id VARCHAR NOT NULL,
+    peer_id VARCHAR NOT NULL,
+    last_message_id INTEGER,
+    last_message TEXT,
+    last_sender_id VARCHAR,
+    last_message_at TIMESTAMP,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, peer_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_private_conversations_user_last ON private_conversations (user_id, last_message_at DESC);
+
+INSERT INTO private_conversations (user_id, peer_id, last_message_id, last_message, last_sender_id, last_message_at, unread_count)
+SELECT last.user_id, last.peer_id, last.id, last.message, last.sender_id, last.created_at,
+       (SELECT COUNT(*) FROM private_messages pm
+        WHERE pm.recipient_id = last.user_id AND pm.sender_id = last.peer_id AND pm.is_read = FALSE)
+FROM (
+    SELECT DISTINCT ON (sides.user_id, sides.peer_id)
+           sides.user_id, sides.peer_id, m.id, m.message, m.sender_id, m.created_at
+    FROM private_messages m
+    CROSS JOIN LATERAL (
+        VALUES (m.sender_id, m.recipient_id), (m.recipient_id, m.sender_id)
+    ) AS sides (user_id, peer_id)
+    ORDER BY sides.user_id, sides.peer_id, m.created_at DESC, m.id DESC
+) last
+ON CONFLICT (user_id, peer_id) DO NOTHING;
@@ -0,0 +1,3 @@
+-- Индекс по упорядоченной паре собеседников: диалог читается одним диапазоном по id вместо bitmap OR
+CREATE INDEX IF NOT EXISTS idx_private_messages_conversation
+    ON private_messages ((LEAST(sender_id, recipient_id)), (GREATEST(sender_id, recipient_id)), id DESC);
@@ -0,0 +1,3 @@
+-- Версия профилей пользователей: auth увеличивает ее при update_profile, чат сбрасывает кэш авторов
+INSERT INTO cache_versions (cache_key, version) VALUES ('user_profiles', 0)
+ON CONFLICT (cache_key) DO NOTHING;
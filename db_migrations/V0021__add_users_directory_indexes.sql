@@ -0,0 +1,5 @@
+-- Каталог пользователей: префиксный поиск и keyset-пагинация по lower(username) в побайтовом порядке
+CREATE INDEX IF NOT EXISTS idx_users_username_lower_c ON users ((lower(username) COLLATE "C"), id);
+
+-- Поиск по подстроке (match=contains); расширение pg_trgm подключено в V0010
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops);
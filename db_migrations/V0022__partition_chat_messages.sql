@@ -0,0 +1,163 @@
+-- Помесячное секционирование chat_messages и private_messages с архивом старых месяцев
+
+CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month_start DATE) RETURNS VOID AS $$
+DECLARE
+    partition_name TEXT := parent || '_p' || to_char(month_start, 'YYYYMM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, parent, month_start, (month_start + INTERVAL '1 month')::date);
+EXCEPTION WHEN check_violation THEN
+    -- В секции по умолчанию уже есть строки за этот месяц; они остаются там, пока их не перенесут вручную
+    RAISE WARNING 'partition % overlaps rows in the default partition of %', partition_name, parent;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ensure_chat_partitions(months_ahead INTEGER) RETURNS VOID AS $$
+DECLARE
+    month_start DATE;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        month_start := (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date;
+        PERFORM create_monthly_partition('chat_messages', month_start);
+        PERFORM create_monthly_partition('private_messages', month_start);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Архив: по строке на источник и день, сообщения лежат в JSONB и сжимаются TOAST
+CREATE TABLE IF NOT EXISTS chat_archive (
+    id BIGSERIAL PRIMARY KEY,
+    source_table TEXT NOT NULL,
+    day DATE NOT NULL,
+    row_count INTEGER NOT NULL,
+    messages JSONB NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (source_table, day)
+);
+
+CREATE OR REPLACE FUNCTION archive_chat_partitions(retention_months INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    part RECORD;
+    cutoff DATE;
+    archived INTEGER := 0;
+BEGIN
+    IF retention_months <= 0 THEN
+        RETURN 0;
+    END IF;
+    cutoff := (date_trunc('month', CURRENT_DATE) - make_interval(months => retention_months))::date;
+
+    FOR part IN
+        SELECT parent.relname AS parent_name, child.relname AS partition_name
+        FROM pg_inherits inh
+        JOIN pg_class parent ON parent.oid = inh.inhparent
+        JOIN pg_class child ON child.oid = inh.inhrelid
+        WHERE parent.relname IN ('chat_messages', 'private_messages')
+          AND child.relname ~ '_p[0-9]{6}$'
+          AND to_date(right(child.relname, 6), 'YYYYMM') < cutoff
+        ORDER BY child.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', part.parent_name, part.partition_name);
+        EXECUTE format($q$
+            INSERT INTO chat_archive (source_table, day, row_count, messages)
+            SELECT %L, created_at::date, COUNT(*), jsonb_agg(to_jsonb(m) ORDER BY created_at, id)
+            FROM %I m
+            GROUP BY created_at::date
+            ON CONFLICT (source_table, day) DO UPDATE SET
+                row_count = chat_archive.row_count + EXCLUDED.row_count,
+                messages = chat_archive.messages || EXCLUDED.messages,
+                archived_at = CURRENT_TIMESTAMP
+        $q$, part.parent_name, part.partition_name);
+        EXECUTE format('DROP TABLE %I', part.partition_name);
+        archived := archived + 1;
+    END LOOP;
+    RETURN archived;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Вызывается функцией чата; advisory lock не дает нескольким экземплярам обслуживать секции одновременно
+CREATE OR REPLACE FUNCTION chat_maintenance(months_ahead INTEGER, retention_months INTEGER) RETURNS INTEGER AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('chat_maintenance')) THEN
+        RETURN 0;
+    END IF;
+    PERFORM ensure_chat_partitions(months_ahead);
+    RETURN archive_chat_partitions(retention_months);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Общий чат
+ALTER TABLE chat_messages RENAME TO chat_messages_legacy;
+ALTER TABLE chat_messages_legacy RENAME CONSTRAINT chat_messages_pkey TO chat_messages_legacy_pkey;
+ALTER INDEX IF EXISTS idx_chat_messages_active_created RENAME TO idx_chat_messages_legacy_active_created;
+
+CREATE TABLE chat_messages (
+    id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    avatar_url TEXT,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE chat_messages_default PARTITION OF chat_messages DEFAULT;
+CREATE INDEX idx_chat_messages_active_created ON chat_messages (is_active, created_at, id);
+
+-- Личные сообщения: последовательность id переходит к новой таблице
+ALTER TABLE private_messages RENAME TO private_messages_legacy;
+ALTER TABLE private_messages_legacy RENAME CONSTRAINT private_messages_pkey TO private_messages_legacy_pkey;
+ALTER INDEX IF EXISTS idx_private_messages_sender RENAME TO idx_private_messages_legacy_sender;
+ALTER INDEX IF EXISTS idx_private_messages_recipient RENAME TO idx_private_messages_legacy_recipient;
+ALTER INDEX IF EXISTS idx_private_messages_conversation RENAME TO idx_private_messages_legacy_conversation;
+
+CREATE TABLE private_messages (
+    id INTEGER NOT NULL DEFAULT nextval('private_messages_id_seq'),
+    sender_id VARCHAR NOT NULL,
+    recipient_id VARCHAR NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    is_read BOOLEAN DEFAULT FALSE,
+    CHECK (sender_id != recipient_id),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE private_messages_id_seq OWNED BY private_messages.id;
+
+CREATE TABLE private_messages_default PARTITION OF private_messages DEFAULT;
+CREATE INDEX idx_private_messages_sender ON private_messages (sender_id);
+CREATE INDEX idx_private_messages_recipient ON private_messages (recipient_id);
+CREATE INDEX idx_private_messages_conversation
+    ON private_messages ((LEAST(sender_id, recipient_id)), (GREATEST(sender_id, recipient_id)), id DESC);
+
+-- Секции под существующую историю и на два месяца вперед, затем перенос строк
+SELECT create_monthly_partition('chat_messages', month_start::date)
+FROM generate_series(
+    date_trunc('month', (SELECT MIN(created_at) FROM chat_messages_legacy)),
+    date_trunc('month', CURRENT_DATE),
+    INTERVAL '1 month'
+) AS month_start;
+
+SELECT create_monthly_partition('private_messages', month_start::date)
+FROM generate_series(
+    date_trunc('month', (SELECT MIN(created_at) FROM private_messages_legacy)),
+    date_trunc('month', CURRENT_DATE),
+    INTERVAL '1 month'
+) AS month_start;
+
+SELECT ensure_chat_partitions(2);
+
+-- Сообщения без даты попадают в секцию по умолчанию как самые старые
+INSERT INTO chat_messages (id, user_id, username, avatar_url, message, created_at, is_active)
+SELECT id, user_id, username, avatar_url, message, COALESCE(created_at, TIMESTAMP '1970-01-01'), is_active
+FROM chat_messages_legacy;
+
+INSERT INTO private_messages (id, sender_id, recipient_id, message, created_at, is_read)
+SELECT id, sender_id, recipient_id, message, COALESCE(created_at, TIMESTAMP '1970-01-01'), is_read
+FROM private_messages_legacy;
+
+DROP TABLE chat_messages_legacy;
+DROP TABLE private_messages_legacy;
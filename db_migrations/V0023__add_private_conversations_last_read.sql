@@ -0,0 +1,10 @@
+-- Отметка прочтения диалога: все сообщения собеседника с id <= last_read_id считаются прочитанными
+ALTER TABLE private_conversations ADD COLUMN IF NOT EXISTS last_read_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE private_conversations c
+SET last_read_id = COALESCE(
+    (SELECT MIN(m.id) - 1 FROM private_messages m
+     WHERE m.sender_id = c.peer_id AND m.recipient_id = c.user_id AND m.is_read = FALSE),
+    c.last_message_id,
+    0
+);
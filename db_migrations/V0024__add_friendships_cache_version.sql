@@ -0,0 +1,3 @@
+-- Версия графа дружбы: accept_friend и remove_friend увеличивают ее, чат сбрасывает кэш друзей
+INSERT INTO cache_versions (cache_key, version) VALUES ('friendships', 0)
+ON CONFLICT (cache_key) DO NOTHING;
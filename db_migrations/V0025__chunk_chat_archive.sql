@@ -0,0 +1,66 @@
+-- Архив по частям: строка архива на источник, день и часть до chunk_rows сообщений,
+-- чтобы загруженный день не упирался в предел размера одного значения JSONB
+ALTER TABLE chat_archive ADD COLUMN IF NOT EXISTS chunk INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE chat_archive DROP CONSTRAINT IF EXISTS chat_archive_source_table_day_key;
+ALTER TABLE chat_archive ADD CONSTRAINT chat_archive_source_table_day_chunk_key UNIQUE (source_table, day, chunk);
+
+DROP FUNCTION IF EXISTS chat_maintenance(INTEGER, INTEGER);
+DROP FUNCTION IF EXISTS archive_chat_partitions(INTEGER);
+
+-- Сначала копируются все старые секции, и только в конце они удаляются:
+-- ACCESS EXCLUSIVE на chat_messages/private_messages держится лишь на время DROP до commit
+CREATE OR REPLACE FUNCTION archive_chat_partitions(retention_months INTEGER, chunk_rows INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    part RECORD;
+    cutoff DATE;
+    partitions TEXT[] := ARRAY[]::TEXT[];
+    partition_name TEXT;
+BEGIN
+    IF retention_months <= 0 THEN
+        RETURN 0;
+    END IF;
+    cutoff := (date_trunc('month', CURRENT_DATE) - make_interval(months => retention_months))::date;
+
+    FOR part IN
+        SELECT parent.relname AS parent_name, child.relname AS partition_name
+        FROM pg_inherits inh
+        JOIN pg_class parent ON parent.oid = inh.inhparent
+        JOIN pg_class child ON child.oid = inh.inhrelid
+        WHERE parent.relname IN ('chat_messages', 'private_messages')
+          AND child.relname ~ '_p[0-9]{6}$'
+          AND to_date(right(child.relname, 6), 'YYYYMM') < cutoff
+        ORDER BY child.relname
+    LOOP
+        EXECUTE format($q$
+            INSERT INTO chat_archive (source_table, day, chunk, row_count, messages)
+            SELECT %L, t.day,
+                   t.chunk + COALESCE((SELECT MAX(a.chunk) + 1 FROM chat_archive a WHERE a.source_table = %L AND a.day = t.day), 0),
+                   COUNT(*), jsonb_agg(t.message ORDER BY t.created_at, t.id)
+            FROM (
+                SELECT created_at::date AS day,
+                       (row_number() OVER (PARTITION BY created_at::date ORDER BY created_at, id) - 1) / %s AS chunk,
+                       created_at, id, to_jsonb(m) AS message
+                FROM %I m
+            ) t
+            GROUP BY t.day, t.chunk
+        $q$, part.parent_name, part.parent_name, GREATEST(chunk_rows, 1), part.partition_name);
+        partitions := partitions || part.partition_name;
+    END LOOP;
+
+    FOREACH partition_name IN ARRAY partitions LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+    END LOOP;
+    RETURN COALESCE(array_length(partitions, 1), 0);
+END;
+$$ LANGUAGE plpgsql;
+
+-- retention_months = 0 только создает секции наперед; архивация запускается по таймеру
+CREATE OR REPLACE FUNCTION chat_maintenance(months_ahead INTEGER, retention_months INTEGER, chunk_rows INTEGER) RETURNS INTEGER AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('chat_maintenance')) THEN
+        RETURN 0;
+    END IF;
+    PERFORM ensure_chat_partitions(months_ahead);
+    RETURN archive_chat_partitions(retention_months, chunk_rows);
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,2 @@
+-- MAX(updated_at) по карточкам входит в отпечаток кэша каталога и читается каждые несколько секунд
+CREATE INDEX IF NOT EXISTS idx_anime_catalog_items_updated_at ON anime_catalog_items (updated_at);
@@ -0,0 +1,42 @@
+-- Новая секция создается отдельной таблицей и подключается через ATTACH: строки ее месяца,
+-- уже попавшие в секцию по умолчанию, сначала переносятся в нее, а не остаются там навсегда
+CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month_start DATE) RETURNS VOID AS $$
+DECLARE
+    partition_name TEXT := parent || '_p' || to_char(month_start, 'YYYYMM');
+    default_name TEXT := parent || '_default';
+    month_end DATE := (month_start + INTERVAL '1 month')::date;
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    -- Пока строки переносятся, новые сообщения за месяц без секции не должны появиться в секции по умолчанию
+    EXECUTE format('LOCK TABLE %I IN EXCLUSIVE MODE', default_name);
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name, parent);
+    EXECUTE format($q$
+        WITH moved AS (
+            DELETE FROM %I WHERE created_at >= %L AND created_at < %L RETURNING *
+        )
+        INSERT INTO %I SELECT * FROM moved
+    $q$, default_name, month_start, month_end, partition_name);
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   parent, partition_name, month_start, month_end);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Кроме секций наперед создаются секции для всех месяцев, чьи строки лежат в секции по умолчанию,
+-- включая перенесенные без даты сообщения за 1970 год; дальше их архивирует обычная ротация
+CREATE OR REPLACE FUNCTION ensure_chat_partitions(months_ahead INTEGER) RETURNS VOID AS $$
+DECLARE
+    parent TEXT;
+    month_start DATE;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['chat_messages', 'private_messages'] LOOP
+        FOR month_start IN EXECUTE format('SELECT DISTINCT date_trunc(''month'', created_at)::date FROM %I', parent || '_default') LOOP
+            PERFORM create_monthly_partition(parent, month_start);
+        END LOOP;
+        FOR i IN 0..months_ahead LOOP
+            PERFORM create_monthly_partition(parent, (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date);
+        END LOOP;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
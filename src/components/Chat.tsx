@@ -46,50 +46,112 @@ interface User {
 }
 
 const CHAT_URL = 'https://functions.poehali.dev/3d6f11fc-510a-4c29-8237-b4aeb4a7d1b0';
+const LONG_POLL_SECONDS = 20;
 
 export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
   const [activeTab, setActiveTab] = useState<'global' | 'friends' | 'private' | 'requests' | 'users'>('global');
   const [messages, setMessages] = useState<Message[]>([]);
+  const [hasOlderMessages, setHasOlderMessages] = useState(false);
   const [friends, setFriends] = useState<Friend[]>([]);
   const [friendRequests, setFriendRequests] = useState<FriendRequest[]>([]);
   const [allUsers, setAllUsers] = useState<User[]>([]);
+  const [userSearch, setUserSearch] = useState('');
+  const [usersCursor, setUsersCursor] = useState<string | null>(null);
+  const [unreadByFriend, setUnreadByFriend] = useState<Record<string, number>>({});
   const [selectedFriend, setSelectedFriend] = useState<Friend | null>(null);
   const [newMessage, setNewMessage] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState('');
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  const lastMessageIdRef = useRef<string | null>(null);
+  const lastAckedIdRef = useRef(0);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
 
-  const fetchGlobalMessages = async () => {
+  const loadMessages = async (url: string, incremental: boolean, signal?: AbortSignal): Promise<boolean> => {
     try {
-      const response = await fetch(`${CHAT_URL}?action=get_messages&limit=50`, {
-        headers: { 'X-Auth-Token': authToken }
+      const response = await fetch(url, {
+        headers: { 'X-Auth-Token': authToken },
+        signal
       });
       const data = await response.json();
-      if (response.ok) {
-        setMessages(data.messages || []);
-        setTimeout(scrollToBottom, 100);
+      if (!response.ok) {
+        return false;
+      }
+      const fetched: Message[] = data.messages || [];
+      if (fetched.length > 0) {
+        lastMessageIdRef.current = String(fetched[fetched.length - 1].id);
       }
+      if (incremental && fetched.length === 0) {
+        return true;
+      }
+      if (!incremental) {
+        setHasOlderMessages(!!data.has_more);
+      }
+      setMessages(prev => {
+        if (!incremental) {
+          return fetched;
+        }
+        const known = new Set(prev.map(msg => msg.id));
+        return [...prev, ...fetched.filter(msg => !known.has(msg.id))];
+      });
+      setTimeout(scrollToBottom, 100);
+      return true;
     } catch (err) {
-      console.error('Ошибка загрузки сообщений:', err);
+      if (!signal?.aborted) {
+        console.error('Ошибка загрузки сообщений:', err);
+      }
+      return false;
     }
   };
 
-  const fetchPrivateMessages = async (friendId: string) => {
+  const fetchGlobalMessages = async (wait = 0, signal?: AbortSignal) => {
+    const afterId = lastMessageIdRef.current;
+    const query = afterId ? `after_id=${encodeURIComponent(afterId)}&wait=${wait}` : 'limit=50';
+    return loadMessages(`${CHAT_URL}?action=get_messages&${query}`, !!afterId, signal);
+  };
+
+  const fetchPrivateMessages = async (friendId: string, wait = 0, signal?: AbortSignal) => {
+    const afterId = lastMessageIdRef.current;
+    const cursor = afterId ? `&after_id=${encodeURIComponent(afterId)}&wait=${wait}` : '';
+    return loadMessages(`${CHAT_URL}?action=get_private_messages&friend_id=${friendId}${cursor}`, !!afterId, signal);
+  };
+
+  const loadOlderMessages = async () => {
+    if (messages.length === 0) {
+      return;
+    }
+    const before = encodeURIComponent(String(messages[0].id));
+    const url = activeTab === 'private' && selectedFriend
+      ? `${CHAT_URL}?action=get_private_messages&friend_id=${selectedFriend.id}&before=${before}&limit=50`
+      : `${CHAT_URL}?action=get_messages&before=${before}&limit=50`;
     try {
-      const response = await fetch(`${CHAT_URL}?action=get_private_messages&friend_id=${friendId}`, {
+      const response = await fetch(url, {
         headers: { 'X-Auth-Token': authToken }
       });
       const data = await response.json();
       if (response.ok) {
-        setMessages(data.messages || []);
-        setTimeout(scrollToBottom, 100);
+        const older: Message[] = data.messages || [];
+        setHasOlderMessages(!!data.has_more);
+        setMessages(prev => {
+          const known = new Set(prev.map(msg => msg.id));
+          return [...older.filter(msg => !known.has(msg.id)), ...prev];
+        });
       }
     } catch (err) {
-      console.error('Ошибка загрузки личных сообщений:', err);
+      console.error('Ошибка загрузки сообщений:', err);
+    }
+  };
+
+  const pollMessages = async (load: (wait: number, signal: AbortSignal) => Promise<boolean>, signal: AbortSignal) => {
+    // Запрос с wait висит на сервере, пока не придет новое сообщение, поэтому интервал не нужен
+    while (!signal.aborted) {
+      const ok = await load(LONG_POLL_SECONDS, signal);
+      if ((!ok || !lastMessageIdRef.current) && !signal.aborted) {
+        await new Promise(resolve => setTimeout(resolve, 3000));
+      }
     }
   };
 
@@ -107,6 +169,24 @@ export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
     }
   };
 
+  const fetchConversations = async () => {
+    try {
+      const response = await fetch(`${CHAT_URL}?action=get_conversations`, {
+        headers: { 'X-Auth-Token': authToken }
+      });
+      const data = await response.json();
+      if (response.ok) {
+        const unread: Record<string, number> = {};
+        for (const conversation of data.conversations || []) {
+          unread[conversation.peer_id] = conversation.unread_count;
+        }
+        setUnreadByFriend(unread);
+      }
+    } catch (err) {
+      console.error('Ошибка загрузки диалогов:', err);
+    }
+  };
+
   const fetchFriendRequests = async () => {
     try {
       const response = await fetch(`${CHAT_URL}?action=get_friend_requests`, {
@@ -121,14 +201,22 @@ export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
     }
   };
 
-  const fetchAllUsers = async () => {
+  const fetchAllUsers = async (cursor: string | null = null) => {
+    const params = new URLSearchParams({ action: 'get_all_users' });
+    if (userSearch.trim()) {
+      params.set('q', userSearch.trim());
+    }
+    if (cursor) {
+      params.set('cursor', cursor);
+    }
     try {
-      const response = await fetch(`${CHAT_URL}?action=get_all_users`, {
+      const response = await fetch(`${CHAT_URL}?${params.toString()}`, {
         headers: { 'X-Auth-Token': authToken }
       });
       const data = await response.json();
       if (response.ok) {
-        setAllUsers(data.users || []);
+        setAllUsers(prev => cursor ? [...prev, ...(data.users || [])] : (data.users || []));
+        setUsersCursor(data.next_cursor || null);
       }
     } catch (err) {
       console.error('Ошибка загрузки пользователей:', err);
@@ -285,25 +373,59 @@ export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
   };
 
   useEffect(() => {
+    lastMessageIdRef.current = null;
+    lastAckedIdRef.current = 0;
+    setHasOlderMessages(false);
     if (activeTab === 'global') {
-      fetchGlobalMessages();
-      const interval = setInterval(fetchGlobalMessages, 3000);
-      return () => clearInterval(interval);
+      const controller = new AbortController();
+      pollMessages(fetchGlobalMessages, controller.signal);
+      return () => controller.abort();
     } else if (activeTab === 'friends') {
       fetchFriends();
+      fetchConversations();
     } else if (activeTab === 'private' && selectedFriend) {
-      fetchPrivateMessages(selectedFriend.id);
-      const interval = setInterval(() => fetchPrivateMessages(selectedFriend.id), 3000);
-      return () => clearInterval(interval);
+      const controller = new AbortController();
+      pollMessages((wait, signal) => fetchPrivateMessages(selectedFriend.id, wait, signal), controller.signal);
+      return () => controller.abort();
     } else if (activeTab === 'requests') {
       fetchFriendRequests();
       const interval = setInterval(fetchFriendRequests, 5000);
       return () => clearInterval(interval);
-    } else if (activeTab === 'users') {
-      fetchAllUsers();
     }
   }, [activeTab, selectedFriend]);
 
+  useEffect(() => {
+    if (activeTab !== 'users') {
+      return;
+    }
+    const timeout = setTimeout(() => fetchAllUsers(), 300);
+    return () => clearTimeout(timeout);
+  }, [activeTab, userSearch]);
+
+  useEffect(() => {
+    if (activeTab !== 'private' || !selectedFriend) {
+      return;
+    }
+    // Подтверждаем прочтение только когда пришло более новое входящее сообщение
+    const incoming = messages.filter(msg => msg.sender_id === selectedFriend.id);
+    const upToId = incoming.length > 0 ? Number(incoming[incoming.length - 1].id) : 0;
+    if (upToId > lastAckedIdRef.current) {
+      lastAckedIdRef.current = upToId;
+      fetch(CHAT_URL, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Auth-Token': authToken
+        },
+        body: JSON.stringify({
+          action: 'mark_read',
+          friend_id: selectedFriend.id,
+          up_to_id: upToId
+        })
+      }).catch(err => console.error('Ошибка отметки прочтения:', err));
+    }
+  }, [messages, activeTab, selectedFriend]);
+
   const renderMessages = () => {
     if (activeTab === 'private' && !selectedFriend) {
       return (
@@ -458,6 +580,11 @@ export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
                           <p className="font-medium truncate">{friend.username}</p>
                           <p className="text-xs text-muted-foreground">Нажмите для переписки</p>
                         </div>
+                        {unreadByFriend[friend.id] > 0 && (
+                          <span className="bg-pink-500 text-white text-xs min-w-5 h-5 px-1.5 rounded-full flex items-center justify-center">
+                            {unreadByFriend[friend.id]}
+                          </span>
+                        )}
                       </div>
                     ))}
                   </div>
@@ -507,6 +634,12 @@ export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
 
           {activeTab === 'users' && (
             <div className="w-full overflow-y-auto p-4">
+              <Input
+                value={userSearch}
+                onChange={(e) => setUserSearch(e.target.value)}
+                placeholder="Поиск по имени..."
+                className="mb-4"
+              />
               <div className="space-y-3">
                 {allUsers.map((user) => (
                   <div key={user.id} className="flex items-center gap-3 p-4 bg-muted rounded-lg">
@@ -524,12 +657,25 @@ export default function Chat({ currentUser, authToken, onClose }: ChatProps) {
                   </div>
                 ))}
               </div>
+              {usersCursor && (
+                <Button variant="ghost" className="w-full mt-3" onClick={() => fetchAllUsers(usersCursor)}>
+                  Показать еще
+                </Button>
+              )}
             </div>
           )}
 
           {(activeTab === 'global' || activeTab === 'private') && (
             <div className="flex-1 flex flex-col">
               <div className="flex-1 overflow-y-auto p-4 space-y-4">
+                {hasOlderMessages && messages.length > 0 && (
+                  <button
+                    onClick={loadOlderMessages}
+                    className="w-full text-center text-sm text-muted-foreground hover:text-foreground transition-colors"
+                  >
+                    Показать более ранние сообщения
+                  </button>
+                )}
                 {renderMessages()}
                 <div ref={messagesEndRef} />
               </div>